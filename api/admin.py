@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta
+
+from flask import Blueprint, jsonify, request
+from flask_jwt_extended import jwt_required
+
+from extenstions import db
+from models import RollupBucket, RollupWatermark
+from rollups import GRANULARITIES, METRICS
+from utils import get_datetime_arg, permission_required
+
+admin_bp = Blueprint('admin', __name__)
+
+DEFAULT_RANGES = {
+    'hour': timedelta(days=2),
+    'day': timedelta(days=30),
+}
+
+@admin_bp.route('/stats', methods=['GET'])
+@jwt_required()
+@permission_required('manage_content')
+def stats():
+    metric = request.args.get('metric', 'sales')
+    granularity = request.args.get('granularity', 'day')
+    if metric not in METRICS or granularity not in GRANULARITIES:
+        return jsonify({
+            "status": "error",
+            "message": f"metric must be one of {', '.join(METRICS)} and granularity one of {', '.join(GRANULARITIES)}."
+        }), 400
+
+    try:
+        end = get_datetime_arg('to') or datetime.utcnow()
+        start = get_datetime_arg('from') or end - DEFAULT_RANGES[granularity]
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    # a primary key range scan, the cost depends on the range asked for and
+    # not on how much history exists
+    buckets = db.session.scalars(
+        db.select(RollupBucket)
+        .where(RollupBucket.metric == metric, RollupBucket.granularity == granularity,
+               RollupBucket.bucket_start >= GRANULARITIES[granularity](start),
+               RollupBucket.bucket_start < end)
+        .order_by(RollupBucket.bucket_start)
+    ).all()
+    watermark = db.session.get(RollupWatermark, metric)
+
+    count = sum(bucket.count for bucket in buckets)
+    total = sum(bucket.sum for bucket in buckets)
+    return jsonify({
+        "status": "success",
+        "metric": metric,
+        "granularity": granularity,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "folded_until": watermark.updated_at if watermark else None,
+        "summary": {
+            "count": count,
+            "sum": str(total),
+            "min": str(min(bucket.min for bucket in buckets)) if buckets else None,
+            "max": str(max(bucket.max for bucket in buckets)) if buckets else None,
+            "avg": str(round(total / count, 2)) if count else None
+        },
+        "buckets": [bucket.to_dict() for bucket in buckets]
+    }), 200
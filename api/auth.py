@@ -2,6 +2,7 @@ from flask import Blueprint, jsonify, request
 from flask_jwt_extended import create_access_token, jwt_required
 
 from extenstions import db
+from hashing import password_hasher
 from models import User
 from utils import validate_request, permission_required
 
@@ -22,14 +23,18 @@ def login():
     password = request_data['password']
 
     user = User.query.filter_by(email=email).first()
-    if not user or not user.check_password(password):
+    if not user or not password_hasher.verify(user.password_hash, password):
         return jsonify({
             "status": "error",
             "message": "Invalid email or password."
         }), 401
 
+    if password_hasher.needs_rehash(user.password_hash):
+        user.password_hash = password_hasher.hash(password)
+        db.session.commit()
+
     roles = [role.name for role in user.roles]
-    token = create_access_token(identity=email, additional_claims={'roles': roles}, expires_delta=False)
+    token = create_access_token(identity=str(user.id), additional_claims={'roles': roles}, expires_delta=False)
     return jsonify({
         "status": "success",
         "message": "Logged in successfully.",
@@ -68,7 +73,7 @@ def register():
         email=email,
         balance=0.0
     )
-    new_user.set_password(password)
+    new_user.password_hash = password_hasher.hash(password)
     db.session.add(new_user)
     db.session.commit()
 
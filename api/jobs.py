@@ -0,0 +1,26 @@
+from flask import Blueprint, jsonify
+from flask_jwt_extended import jwt_required, get_current_user
+
+from extenstions import db
+from models import Job
+from rbac import has_permission
+
+jobs_bp = Blueprint('jobs', __name__)
+
+@jobs_bp.route('/<int:job_id>', methods=['GET'])
+@jwt_required()
+def get_job(job_id):
+    job = db.session.get(Job, job_id)
+    user = get_current_user()
+
+    # jobs of other users are reported as missing rather than forbidden
+    if not job or (job.created_by != user.id and not has_permission(user, 'manage_users')):
+        return jsonify({
+            "status": "error",
+            "message": f"Job with ID {job_id} not found."
+        }), 404
+
+    return jsonify({
+        "status": "success",
+        "job": job.to_dict()
+    }), 200
@@ -1,12 +1,25 @@
+import csv
+import io
+import json
 from datetime import datetime
-from decimal import Decimal
 
-from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
+import click
+from flask import Blueprint, current_app, jsonify, request, url_for
+from flask_jwt_extended import jwt_required, get_current_user
 
+from cache import response_cache
+from catalogue import cursor_page, explain, parse_listing_filters, parse_sort, sort_keys, supported_queries
+from deletion import delete_listing_cascade
+from export import get_export_format, stream_export
 from extenstions import db
-from models import Listing, User, Purchase
-from utils import validate_request
+from idempotency import idempotent
+from models import ArchivedListing, Listing, Purchase
+from rbac import has_permission
+from search import SearchUnavailable, search_statement
+from stats import adjust_stats, sale_deltas
+from serializers import LISTING_FIELDS, get_fields_arg, json_response, listing_projection
+from utils import validate_request, parse_price, get_page_args, paginate_rows, encode_cursor, decode_cursor
+from wallet import debit
 
 listings_bp = Blueprint('listings', __name__)
 
@@ -27,17 +40,14 @@ def create_listing():
     price = request_data['price']
 
     try:
-        price = Decimal(price)
-        if price <= 0:
-            raise ValueError("Price must be a positive number.")
-    except (ValueError, TypeError):
+        price = parse_price(price)
+    except ValueError as e:
         return jsonify({
             "status": "error",
-            "message": "Price must be a positive number."
+            "message": str(e)
         }), 400
 
-    email = get_jwt_identity()
-    user = User.query.filter_by(email=email).first()
+    user = get_current_user()
 
     new_listing = Listing(
         user_id=user.id,
@@ -50,6 +60,7 @@ def create_listing():
 
     try:
         db.session.add(new_listing)
+        adjust_stats({user.id: {'active_listings': 1}})
         db.session.commit()
     except Exception as e:
         db.session.rollback()
@@ -58,6 +69,8 @@ def create_listing():
             "message": f"An error occurred while creating the listing: {str(e)}"
         }), 500
 
+    response_cache.invalidate('listings')
+
     return jsonify({
         "status": "success",
         "message": "Listing created successfully.",
@@ -72,27 +85,270 @@ def create_listing():
         }
     }), 201
 
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+def read_ndjson_rows(stream):
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield ValueError("Row is not valid JSON.")
+            continue
+        yield row if isinstance(row, dict) else ValueError("Row must be a JSON object.")
+
+def read_csv_rows(stream):
+    yield from csv.DictReader(stream)
+
+@listings_bp.route('/bulk', methods=['POST'])
+@jwt_required()
+def bulk_create_listings():
+    if request.mimetype in NDJSON_MIMETYPES:
+        reader = read_ndjson_rows
+    elif request.mimetype == 'text/csv':
+        reader = read_csv_rows
+    else:
+        return jsonify({
+            "status": "error",
+            "message": "Send the listings as application/x-ndjson or text/csv."
+        }), 415
+
+    user_id = get_current_user().id
+    batch_size = current_app.config['BULK_INSERT_BATCH_SIZE']
+    max_errors = current_app.config['BULK_MAX_REPORTED_ERRORS']
+    title_length = Listing.title.type.length
+
+    inserted = 0
+    failed = 0
+    errors = []
+    batch = []
+    batch_rows = None
+
+    def report(row, message):
+        nonlocal failed
+        failed += 1
+        if len(errors) < max_errors:
+            errors.append({"row": row, "message": message})
+
+    def flush():
+        nonlocal inserted, failed, batch
+        if batch:
+            try:
+                db.session.execute(db.insert(Listing), batch)
+                adjust_stats({user_id: {'active_listings': len(batch)}})
+                db.session.commit()
+                response_cache.invalidate('listings')
+                inserted += len(batch)
+            except Exception as e:
+                db.session.rollback()
+                failed += len(batch)
+                if len(errors) < max_errors:
+                    errors.append({
+                        "rows": f"{batch_rows[0]}-{batch_rows[1]}",
+                        "message": f"An error occurred while inserting the batch: {str(e)}"
+                    })
+        batch = []
+
+    # the body is read line by line, only one batch of rows is held in memory
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', errors='replace')
+    for row_number, row in enumerate(reader(stream), start=1):
+        if isinstance(row, Exception):
+            report(row_number, str(row))
+            continue
+
+        validation_error = validate_request(row, ['title', 'description', 'price'])
+        if validation_error:
+            report(row_number, validation_error)
+            continue
+
+        if not isinstance(row['title'], str) or not isinstance(row['description'], str):
+            report(row_number, "Title and description must be strings.")
+            continue
+
+        if len(row['title']) > title_length:
+            report(row_number, f"Title must be at most {title_length} characters.")
+            continue
+
+        try:
+            price = parse_price(row['price'])
+        except ValueError as e:
+            report(row_number, str(e))
+            continue
+
+        batch_rows = (row_number if not batch else batch_rows[0], row_number)
+        now = datetime.utcnow()
+        batch.append({
+            "user_id": user_id,
+            "title": row['title'],
+            "description": row['description'],
+            "price": price,
+            "status": 'active',
+            "created_at": now,
+            "updated_at": now
+        })
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    return jsonify({
+        "status": "success" if inserted else "error",
+        "inserted": inserted,
+        "failed": failed,
+        "errors": errors
+    }), 201 if inserted else 400
+
 @listings_bp.route('/', methods=['GET'])
+@response_cache.cached('listings')
 def get_listings():
-    page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 20, type=int)
+    page, per_page = get_page_args()
+    cursor_mode = 'cursor' in request.args
+
+    try:
+        fields = get_fields_arg(LISTING_FIELDS)
+        filters = parse_listing_filters(request.args)
+        sort, descending = parse_sort(request.args.get('sort'), 'created_at' if cursor_mode else 'id')
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    # filters and sorts are backed by indexes for keyset pages only, OFFSET
+    # pages and their total count would read every matching row
+    if not cursor_mode and (filters or (sort, descending) != ('id', False)):
+        return jsonify({
+            "status": "error",
+            "message": "Filters and sort need cursor pagination, pass cursor= (empty) for the first page."
+        }), 400
+
+    # cursor mode, pass ?cursor= (empty) for the first page and next_cursor afterwards
+    if cursor_mode:
+        return get_listings_after_cursor(request.args['cursor'], per_page, fields, filters, sort, descending)
+
+    # only the requested columns are selected, rows never become Listing objects
+    columns, encode = listing_projection(fields)
+    pagination, rows = paginate_rows(db.select(*columns).order_by(Listing.id), page, per_page)
+
+    return json_response({
+        "status": "success",
+        **pagination,
+        "listings": [encode(row) for row in rows]
+    })
+
+def get_listings_after_cursor(cursor, per_page, fields, filters, sort, descending):
+    keys = sort_keys(sort)
+    columns, encode = listing_projection(fields, keys)
+
+    # the cursor starts with the sort it was issued for, followed by the sort
+    # key values of the last row on the previous page
+    sort_spec = f"-{sort}" if descending else sort
+    position = None
+    try:
+        if cursor:
+            values = decode_cursor(cursor)
+            if values[:1] != [sort_spec]:
+                raise ValueError("Cursor does not match the requested sort.")
+            position = values[1:]
+        # fetch one extra row to know whether there is a next page without counting
+        statement = cursor_page(db.select(*columns), filters, sort, descending, position, per_page + 1)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    rows = db.session.execute(statement).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
+    next_cursor = None
+    if has_more:
+        next_cursor = encode_cursor(sort_spec, *rows[-1][-len(keys):])
+
+    return json_response({
+        "status": "success",
+        "per_page": per_page,
+        "next_cursor": next_cursor,
+        "listings": [encode(row) for row in rows]
+    })
+
+@listings_bp.route('/search', methods=['GET'])
+@response_cache.cached('listings')
+def search_listings():
+    text = request.args.get('q', '').strip()
+    if not text:
+        return jsonify({
+            "status": "error",
+            "message": "Missing fields: q"
+        }), 400
 
-    paginated_listings = Listing.query.paginate(page=page, per_page=per_page, error_out=False)
+    # only active listings unless another status (or "all") is asked for
+    status = request.args.get('status', 'active')
+    if status == 'all':
+        status = None
 
-    response = {
+    page, per_page = get_page_args()
+    try:
+        fields = get_fields_arg(LISTING_FIELDS)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    columns, encode = listing_projection(fields)
+    try:
+        statement = search_statement(columns, text, status)
+    except SearchUnavailable as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 501
+
+    # one extra row tells whether there is a next page, ranked matches are not counted
+    rows = db.session.execute(statement.limit(per_page + 1).offset((page - 1) * per_page)).all()
+
+    return json_response({
         "status": "success",
-        "page": paginated_listings.page,
-        "per_page": paginated_listings.per_page,
-        "total_items": paginated_listings.total,
-        "total_pages": paginated_listings.pages,
-        "listings": [listing.to_dict() for listing in paginated_listings.items]
-    }
+        "page": page,
+        "per_page": per_page,
+        "has_more": len(rows) > per_page,
+        "listings": [encode(row) for row in rows[:per_page]]
+    })
+
+@listings_bp.route('/export', methods=['GET'])
+def export_listings():
+    try:
+        export_format = get_export_format()
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    statement = db.select(
+        Listing.id,
+        Listing.user_id,
+        Listing.title,
+        Listing.description,
+        Listing.price,
+        Listing.status,
+        Listing.created_at,
+        Listing.updated_at
+    ).order_by(Listing.id)
 
-    return jsonify(response), 200
+    status = request.args.get('status')
+    if status:
+        statement = statement.where(Listing.status == status)
+
+    return stream_export(statement, export_format, 'listings')
 
 @listings_bp.route('/<int:listing_id>', methods=['GET'])
+@response_cache.cached(lambda listing_id: f"listing:{listing_id}")
 def get_listing(listing_id):
-    listing = Listing.query.get(listing_id)
+    # sold listings move to the archive after LISTING_ARCHIVE_AFTER_DAYS
+    listing = Listing.query.get(listing_id) or db.session.get(ArchivedListing, listing_id)
 
     if not listing:
         return jsonify({
@@ -107,9 +363,9 @@ def get_listing(listing_id):
 
 @listings_bp.route('/<int:listing_id>/buy', methods=['POST'])
 @jwt_required()
+@idempotent
 def buy_listing(listing_id):
-    current_user_email = get_jwt_identity()
-    buyer = User.query.filter_by(email=current_user_email).first()
+    buyer = get_current_user()
 
     # this should never happen because the token would belong to the buyer
     if not buyer:
@@ -137,19 +393,33 @@ def buy_listing(listing_id):
             "message": "Listing is not available for purchase"
         }), 400
 
-    if buyer.balance < listing.price:
+    # both writes are conditional updates evaluated by the database, so two
+    # concurrent buyers cannot both win the listing and the wallet debit
+    # cannot overdraw the buyer
+    sold = (Listing.query
+            .filter(Listing.id == listing.id, Listing.status == 'active')
+            .update({'status': 'sold', 'updated_at': datetime.utcnow()}, synchronize_session='evaluate'))
+    if not sold:
+        db.session.rollback()
         return jsonify({
             "status": "error",
-            "message": "Insufficient balance"
+            "message": "Listing is not available for purchase"
         }), 400
 
-    buyer.balance -= listing.price
-    listing.status = 'sold'
+    if not debit(buyer.id, listing.price, 'purchase'):
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": "Insufficient balance"
+        }), 400
 
     purchase = Purchase(listing_id=listing.id, buyer_id=buyer.id)
     db.session.add(purchase)
+    adjust_stats(sale_deltas([(listing.user_id, buyer.id, listing.price)]))
+    db.session.flush()
 
-    db.session.commit()
+    # @idempotent commits, together with the response it stores for the key
+    response_cache.invalidate_on_commit('listings', f"listing:{listing_id}")
 
     return jsonify({
         "status": "success",
@@ -158,6 +428,112 @@ def buy_listing(listing_id):
         "listing": listing.to_dict()
     }), 200
 
+@listings_bp.route('/checkout', methods=['POST'])
+@jwt_required()
+@idempotent
+def checkout():
+    request_data = request.get_json()
+    validation_error = validate_request(request_data, ['listing_ids'])
+    if validation_error:
+        return jsonify({
+            "status": "error",
+            "message": validation_error
+        }), 400
+
+    listing_ids = request_data['listing_ids']
+    max_items = current_app.config['CHECKOUT_MAX_ITEMS']
+    if (not isinstance(listing_ids, list) or not listing_ids
+            or not all(isinstance(listing_id, int) and not isinstance(listing_id, bool) for listing_id in listing_ids)):
+        return jsonify({
+            "status": "error",
+            "message": "listing_ids must be a non-empty list of listing IDs."
+        }), 400
+    listing_ids = sorted(set(listing_ids))
+    if len(listing_ids) > max_items:
+        return jsonify({
+            "status": "error",
+            "message": f"A checkout can contain at most {max_items} listings."
+        }), 400
+
+    buyer = get_current_user()
+
+    # one query validates every item; rows are locked in id order so
+    # overlapping checkouts on Postgres queue up instead of deadlocking
+    listings = db.session.execute(
+        db.select(Listing.id, Listing.user_id, Listing.status)
+        .where(Listing.id.in_(listing_ids))
+        .order_by(Listing.id)
+        .with_for_update()
+    ).all()
+
+    missing = sorted(set(listing_ids) - {listing.id for listing in listings})
+    if missing:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": "Listings not found.",
+            "listing_ids": missing
+        }), 404
+
+    if any(listing.user_id == buyer.id for listing in listings):
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": "You cannot buy your own listing."
+        }), 400
+
+    unavailable = [listing.id for listing in listings if listing.status != 'active']
+    if unavailable:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": "Listings are not available for purchase.",
+            "listing_ids": unavailable
+        }), 400
+
+    # the conditional update is what makes the checkout safe where the select
+    # above does not lock (SQLite): a concurrent checkout that sold any of the
+    # items leaves fewer rows to update and this one backs out
+    sold = db.session.execute(
+        db.update(Listing)
+        .where(Listing.id.in_(listing_ids), Listing.status == 'active')
+        .values(status='sold', updated_at=datetime.utcnow())
+        .returning(Listing.id, Listing.price, Listing.user_id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if len(sold) != len(listing_ids):
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": "Listings are not available for purchase.",
+            "listing_ids": sorted(set(listing_ids) - {listing_id for listing_id, _, _ in sold})
+        }), 400
+
+    total = sum(price for _, price, _ in sold)
+    if not debit(buyer.id, total, 'purchase'):
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": "Insufficient balance"
+        }), 400
+
+    purchases = db.session.scalars(
+        db.insert(Purchase).returning(Purchase),
+        [{'listing_id': listing_id, 'buyer_id': buyer.id} for listing_id in listing_ids]
+    ).all()
+    adjust_stats(sale_deltas([(seller_id, buyer.id, price) for _, price, seller_id in sold]))
+    purchases = [purchase.to_dict() for purchase in purchases]
+
+    # @idempotent commits, together with the response it stores for the key
+    response_cache.invalidate_on_commit('listings', *(f"listing:{listing_id}" for listing_id in listing_ids))
+
+    return jsonify({
+        "status": "success",
+        "message": "Checkout completed successfully.",
+        "total": str(total),
+        "purchases": purchases
+    }), 200
+
 
 @listings_bp.route('/delete/<int:listing_id>', methods=['DELETE'])
 @jwt_required()
@@ -170,25 +546,56 @@ def delete_listing(listing_id):
             "message": f"Listing with ID {listing_id} not found."
         }), 404
 
-    email = get_jwt_identity()
-    user = User.query.filter_by(email=email).first()
+    user = get_current_user()
 
-    if not user.id == listing.user_id and not user.has_permission('manage_listings'):
+    if not user.id == listing.user_id and not has_permission(user, 'manage_listings'):
         return jsonify({
             "status": "error",
             "message": "You are not authorized to delete listings."
         }), 400
 
-    try:
-        db.session.delete(listing)
-        db.session.commit()
-    except Exception as e:
+    # sold listings stay, their purchases are the buyers' history
+    if listing.status != 'active':
         return jsonify({
             "status": "error",
-            "message": f"An error occurred while deleting the listing: {str(e)}"
-        }), 500
+            "message": "Only active listings can be deleted, sold listings are kept for their buyers."
+        }), 409
+
+    # taken off sale right away and deleted by a job. The update only applies
+    # while the listing is still active, so a purchase committed since the
+    # read above is not overwritten.
+    flipped = (Listing.query
+               .filter(Listing.id == listing_id, Listing.status == 'active')
+               .update({'status': 'deleted', 'updated_at': datetime.utcnow()}, synchronize_session=False))
+    if not flipped:
+        db.session.rollback()
+        return jsonify({
+            "status": "error",
+            "message": f"Listing with ID {listing_id} changed while it was being deleted, please try again."
+        }), 409
+
+    adjust_stats({listing.user_id: {'active_listings': -1}})
+    job = delete_listing_cascade.enqueue(created_by=user.id, listing_id=listing_id)
+    db.session.commit()
+    response_cache.invalidate('listings', f"listing:{listing_id}")
 
     return jsonify({
         "status": "success",
-        "message": f"Listing with ID {listing_id} deleted successfully."
-    }), 200
\ No newline at end of file
+        "message": f"Deletion of listing with ID {listing_id} has been queued.",
+        "job": job.to_dict()
+    }), 202, {'Location': url_for('jobs.get_job', job_id=job.id)}
+
+@listings_bp.cli.command('check-query-plans')
+def check_query_plans():
+    """EXPLAIN every supported filter/sort combination and fail on table scans."""
+    full_scans = 0
+    for label, statement in supported_queries():
+        plan, full_scan = explain(statement)
+        if full_scan:
+            full_scans += 1
+            click.echo(f"FULL SCAN  {label}: {' / '.join(plan)}")
+        else:
+            click.echo(f"ok         {label}")
+
+    if full_scans:
+        raise click.ClickException(f"{full_scans} supported queries scan the whole listings table.")
@@ -1,39 +1,73 @@
-from decimal import Decimal
-
-from flask import Blueprint, jsonify, request
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask import Blueprint, jsonify, request, url_for
+from flask_jwt_extended import jwt_required, get_current_user
+from sqlalchemy.orm import contains_eager
 
+from deletion import delete_user_cascade
+from export import get_export_format, stream_export
 from extenstions import db
-from models import User, Listing, Purchase
-from utils import validate_request, permission_required
+from idempotency import idempotent
+from models import User, ArchivedListing, Listing, Purchase
+from principal import PrincipalGone
+from serializers import LISTING_FIELDS, get_fields_arg, json_response, listing_projection, serialize_user
+from utils import validate_request, permission_required, get_page_args, get_datetime_arg, paginate_rows, parse_amount, MAX_AMOUNT
+from stats import get_stats
+from wallet import credit, debit, get_balance
 
 users_bp = Blueprint('users', __name__)
 
+def get_current_balance(user):
+    balance = get_balance(user.id)
+    if balance is None:
+        # deleted elsewhere while this worker still had the principal cached
+        raise PrincipalGone(user.id)
+    return balance
+
 @users_bp.route('/me', methods=['GET'])
 @jwt_required()
 def me():
-    email = get_jwt_identity()
-    user = User.query.filter_by(email=email).first()
-    return jsonify(user.to_dict()), 200
+    user = get_current_user()
+    return json_response(serialize_user(user, get_current_balance(user)))
+
+@users_bp.route('/me/stats', methods=['GET'])
+@jwt_required()
+def me_stats():
+    # a single primary key lookup, the counters are kept up to date on write
+    stats = get_stats(get_current_user().id)
+    return jsonify({
+        "status": "success",
+        "stats": stats.to_dict()
+    }), 200
 
 @users_bp.route('/me/listings', methods=['GET'])
 @jwt_required()
 def me_listings():
-    email = get_jwt_identity()
-    user = User.query.filter_by(email=email).first()
+    user = get_current_user()
+
+    try:
+        fields = get_fields_arg(LISTING_FIELDS)
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
 
-    listings = Listing.query.filter_by(user_id=user.id).all()
+    page, per_page = get_page_args()
+    columns, encode = listing_projection(fields)
+    statement = (db.select(*columns)
+                 .where(Listing.user_id == user.id)
+                 .order_by(Listing.created_at, Listing.id))
+    pagination, rows = paginate_rows(statement, page, per_page)
 
-    return jsonify({
+    return json_response({
         "status": "success",
-        "listings": [listing.to_dict() for listing in listings]
-    }), 200
+        **pagination,
+        "listings": [encode(row) for row in rows]
+    })
 
 @users_bp.route('/wallet/deposit', methods=['POST'])
 @jwt_required()
+@idempotent
 def wallet_deposit():
-    email = get_jwt_identity()
-
     request_data = request.get_json()
     validation_error = validate_request(request_data, ['amount'])
     if validation_error:
@@ -43,7 +77,7 @@ def wallet_deposit():
         }), 400
 
     # should never happen
-    user = User.query.filter_by(email=email).first()
+    user = get_current_user()
     if not user:
         return jsonify({
             "status": "error",
@@ -51,32 +85,33 @@ def wallet_deposit():
         }), 404
 
     try:
-        amount = Decimal(request_data['amount'])
-        if amount <= 0:
-            return jsonify({
-                "status": "error",
-                "message": "Deposit amount must be greater than zero."
-            }), 400
-    except (ValueError, TypeError):
+        amount = parse_amount(request_data['amount'])
+    except ValueError as e:
         return jsonify({
             "status": "error",
-            "message": "Invalid amount provided."
+            "message": str(e)
         }), 400
 
-    user.balance += amount
-    db.session.commit()
+    # users.balance is Numeric(10, 2) as well, so the total has to fit too
+    if get_current_balance(user) + amount > MAX_AMOUNT:
+        return jsonify({
+            "status": "error",
+            "message": f"Balance cannot exceed {MAX_AMOUNT}."
+        }), 400
+
+    # @idempotent commits, together with the response it stores for the key
+    credit(user.id, amount, 'deposit')
 
     return jsonify({
         "status": "success",
         "message": f"Successfully deposited {amount:.2f}.",
-        "new_balance": str(user.balance)
+        "new_balance": str(get_balance(user.id))
     }), 200
 
 @users_bp.route('/wallet/withdraw', methods=['POST'])
 @jwt_required()
+@idempotent
 def wallet_withdraw():
-    email = get_jwt_identity()
-
     request_data = request.get_json()
     validation_error = validate_request(request_data, ['amount'])
     if validation_error:
@@ -86,7 +121,7 @@ def wallet_withdraw():
         }), 400
 
     # should never happen
-    user = User.query.filter_by(email=email).first()
+    user = get_current_user()
     if not user:
         return jsonify({
             "status": "error",
@@ -94,25 +129,27 @@ def wallet_withdraw():
         }), 404
 
     try:
-        amount = Decimal(request_data['amount'])
-        if amount <= 0:
-            return jsonify({
-                "status": "error",
-                "message": "Withdrawal amount must be greater than zero."
-            }), 400
-    except (ValueError, TypeError):
+        amount = parse_amount(request_data['amount'])
+    except ValueError as e:
         return jsonify({
             "status": "error",
-            "message": "Invalid amount provided."
+            "message": str(e)
         }), 400
 
-    user.balance -= amount
-    db.session.commit()
+    if not debit(user.id, amount, 'withdrawal'):
+        db.session.rollback()
+        # a user deleted elsewhere fails the debit too, that is a 401
+        get_current_balance(user)
+        return jsonify({
+            "status": "error",
+            "message": "Insufficient balance."
+        }), 400
+    # @idempotent commits, together with the response it stores for the key
 
     return jsonify({
         "status": "success",
         "message": f"Successfully withdrawn {amount:.2f}.",
-        "new_balance": str(user.balance)
+        "new_balance": str(get_balance(user.id))
     }), 200
 
 @users_bp.route('/delete/<int:user_id>', methods=['DELETE'])
@@ -126,35 +163,88 @@ def delete_user(user_id):
             "message": "User not found."
         }), 404
 
-    try:
-        db.session.delete(to_delete)
-        db.session.commit()
-    except Exception as e:
-        return jsonify({
-            "status": "error",
-            "message": f"An error occurred while deleting the user: {str(e)}"
-        }), 500
+    # listings, purchases and wallet entries are removed in batches by a job
+    job = delete_user_cascade.enqueue(created_by=get_current_user().id, user_id=user_id)
+    db.session.commit()
 
     return jsonify({
         "status": "success",
-        "message": f"User with ID {user_id} deleted successfully."
-    }), 200
+        "message": f"Deletion of user with ID {user_id} has been queued.",
+        "job": job.to_dict()
+    }), 202, {'Location': url_for('jobs.get_job', job_id=job.id)}
 
 @users_bp.route('/me/purchases', methods=['GET'])
 @jwt_required()
 def me_purchases():
-    email = get_jwt_identity()
-    user = User.query.filter_by(email=email).first()
+    user = get_current_user()
 
-    purchases = Purchase.query.filter_by(buyer_id=user.id).all()
+    try:
+        purchased_after = get_datetime_arg('purchased_after')
+        purchased_before = get_datetime_arg('purchased_before')
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    # listings are joined into the same SELECT instead of being fetched one by
+    # one, from either table since old sales are archived
+    query = (Purchase.query.filter(Purchase.buyer_id == user.id)
+             .outerjoin(Purchase.listing)
+             .outerjoin(Purchase.archived_listing)
+             .options(contains_eager(Purchase.listing), contains_eager(Purchase.archived_listing)))
+    if purchased_after:
+        query = query.filter(Purchase.purchased_at >= purchased_after)
+    if purchased_before:
+        query = query.filter(Purchase.purchased_at < purchased_before)
+
+    page, per_page = get_page_args()
+    paginated_purchases = (query.order_by(Purchase.purchased_at, Purchase.id)
+                           .paginate(page=page, per_page=per_page, error_out=False))
 
     return jsonify({
         "status": "success",
+        "page": paginated_purchases.page,
+        "per_page": paginated_purchases.per_page,
+        "total_items": paginated_purchases.total,
+        "total_pages": paginated_purchases.pages,
         "purchases": [
             {
                 **purchase.to_dict(),
-                "listing": Listing.query.filter_by(id=purchase.listing_id).first().to_dict()
+                "listing": purchase.any_listing.to_dict()
             }
-            for purchase in purchases
+            for purchase in paginated_purchases.items
         ]
-    })
\ No newline at end of file
+    })
+
+@users_bp.route('/me/purchases/export', methods=['GET'])
+@jwt_required()
+def export_me_purchases():
+    user = get_current_user()
+
+    try:
+        export_format = get_export_format()
+        purchased_after = get_datetime_arg('purchased_after')
+        purchased_before = get_datetime_arg('purchased_before')
+    except ValueError as e:
+        return jsonify({
+            "status": "error",
+            "message": str(e)
+        }), 400
+
+    statement = (
+        db.select(Purchase.id, Purchase.listing_id, Purchase.purchased_at,
+                  db.func.coalesce(Listing.user_id, ArchivedListing.user_id).label('seller_id'),
+                  db.func.coalesce(Listing.title, ArchivedListing.title).label('title'),
+                  db.func.coalesce(Listing.price, ArchivedListing.price).label('price'))
+        .outerjoin(Purchase.listing)
+        .outerjoin(Purchase.archived_listing)
+        .where(Purchase.buyer_id == user.id)
+        .order_by(Purchase.purchased_at, Purchase.id)
+    )
+    if purchased_after:
+        statement = statement.where(Purchase.purchased_at >= purchased_after)
+    if purchased_before:
+        statement = statement.where(Purchase.purchased_at < purchased_before)
+
+    return stream_export(statement, export_format, 'purchases')
@@ -1,10 +1,29 @@
+import time
+
+import click
 from flask import Flask
+from flask.cli import with_appcontext
 from flask_cors import CORS
 
-from api import auth, listings, users
+from api import admin, auth, jobs, listings, users
+from cache import init_cache
 from extenstions import migrate, db, jwt
+from hashing import init_hasher
+from idempotency import idempotency_cli
+from jobs import init_jobs
+from lifecycle import lifecycle_cli
+from limiter import init_limiter
+from metrics import init_metrics, record_startup
 from models import Role, Permission
+from pool import configure_engines, init_pool
+from principal import init_principal
+from rbac import init_rbac
+from replica import init_replica
+from rollups import rollups_cli
+from search import search_cli
+from stats import stats_cli
 from utils import register_error_handlers
+from wallet import wallet_cli
 
 
 def seed_roles_and_permissions():
@@ -24,25 +43,61 @@ def seed_roles_and_permissions():
     db.session.commit()
     print("Seeded roles and permissions")
 
+def init_db():
+    db.create_all()
+    seed_roles_and_permissions()
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create the schema and seed roles and permissions."""
+    init_db()
+    click.echo("Database initialised.")
+
 def create_app():
+    started_at = time.perf_counter()
     app = Flask(__name__)
     app.config.from_object("config")
 
+    configure_engines(app)
     db.init_app(app)
     jwt.init_app(app)
     migrate.init_app(app, db)
 
+    init_cache(app)
+    init_hasher(app)
+    init_principal(app)
+    init_rbac(app)
+    init_metrics(app)
+    init_limiter(app)
+    init_pool(app)
+    init_replica(app)
+    init_jobs(app)
     register_error_handlers(app)
 
     app.register_blueprint(auth.auth_bp, url_prefix='/api/v1/auth')
     app.register_blueprint(listings.listings_bp, url_prefix='/api/v1/listings')
     app.register_blueprint(users.users_bp, url_prefix='/api/v1/users')
+    app.register_blueprint(jobs.jobs_bp, url_prefix='/api/v1/jobs')
+    app.register_blueprint(admin.admin_bp, url_prefix='/api/v1/admin')
 
     CORS(app)
 
-    with app.app_context():
-        db.create_all()
-        seed_roles_and_permissions()
+    app.cli.add_command(search_cli)
+    app.cli.add_command(wallet_cli)
+    app.cli.add_command(lifecycle_cli)
+    app.cli.add_command(stats_cli)
+    app.cli.add_command(rollups_cli)
+    app.cli.add_command(idempotency_cli)
+    app.cli.add_command(init_db_command)
+
+    # with DB_AUTO_INIT off, run `flask init-db` once per deploy instead; the
+    # app then opens no connection until the first request
+    if app.config['DB_AUTO_INIT']:
+        with app.app_context():
+            init_db()
+
+    record_startup(app, time.perf_counter() - started_at)
     return app
 
 if __name__ == '__main__':
@@ -0,0 +1,278 @@
+# Drives a mixed browse/view/login/buy/deposit workload through create_app
+# and reports latency percentiles, throughput and queries per request for
+# each endpoint.
+#
+#   python -m benchmarks.loadtest --users 200 --listings 20000 --threads 8 --duration 20 \
+#       --output results.json --baseline baseline.json
+#
+# Runs against a throwaway SQLite file unless --database-uri is given. Seeding
+# assumes an empty database.
+import argparse
+import json
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+DEFAULT_MIX = 'browse=50,view=30,deposit=10,buy=7,login=3'
+PASSWORD = 'loadtest'
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation '{name}', expected one of {', '.join(OPERATIONS)}.")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mixed workload load test")
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--listings', type=int, default=10000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help="seconds to run the workload for")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help=f"operation weights (default: {DEFAULT_MIX})")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--password-hash-method', default='pbkdf2:sha256:1000000',
+                        help="hash method for seeded users; lower it to keep login from dominating")
+    parser.add_argument('--no-cache', action='store_true', help="disable the response cache")
+    parser.add_argument('--database-uri')
+    parser.add_argument('--output', help="write results to this JSON file")
+    parser.add_argument('--baseline', help="compare against a previous --output file")
+    parser.add_argument('--max-regression', type=float, default=20,
+                        help="percent p95 or throughput regression that fails the run against --baseline")
+    return parser.parse_args()
+
+
+def browse(client, rng, state):
+    page = rng.randint(1, state['pages'])
+    return client.get(f"/api/v1/listings/?page={page}")
+
+
+def view(client, rng, state):
+    return client.get(f"/api/v1/listings/{rng.choice(state['listing_ids'])}")
+
+
+def login(client, rng, state):
+    email = state['emails'][rng.choice(state['user_ids'])]
+    return client.post('/api/v1/auth/login', json={'email': email, 'password': PASSWORD})
+
+
+def buy(client, rng, state):
+    user_id = rng.choice(state['user_ids'])
+    return client.post(f"/api/v1/listings/{rng.choice(state['listing_ids'])}/buy",
+                       headers=state['headers'][user_id])
+
+
+def deposit(client, rng, state):
+    user_id = rng.choice(state['user_ids'])
+    return client.post('/api/v1/users/wallet/deposit', json={'amount': '5.00'},
+                       headers=state['headers'][user_id])
+
+
+OPERATIONS = {
+    'browse': browse,
+    'view': view,
+    'login': login,
+    'buy': buy,
+    'deposit': deposit,
+}
+
+
+def seed(app, args):
+    from flask_jwt_extended import create_access_token
+    from werkzeug.security import generate_password_hash
+
+    from extenstions import db
+    from models import Listing, User
+
+    rng = random.Random(args.seed)
+    password_hash = generate_password_hash(PASSWORD, method=args.password_hash_method)
+    batch_size = app.config['BULK_INSERT_BATCH_SIZE']
+    now = datetime.utcnow()
+
+    with app.app_context():
+        db.session.execute(db.insert(User), [
+            {'username': f"loadtest{i}", 'email': f"loadtest{i}@example.com",
+             'password_hash': password_hash, 'balance': Decimal('1000000.00')}
+            for i in range(args.users)
+        ])
+        db.session.commit()
+        users = db.session.execute(db.select(User.id, User.email).where(User.username.like('loadtest%'))).all()
+        user_ids = [user_id for user_id, _ in users]
+
+        for offset in range(0, args.listings, batch_size):
+            rows = []
+            for i in range(offset, min(offset + batch_size, args.listings)):
+                created_at = now - timedelta(seconds=args.listings - i)
+                rows.append({'user_id': rng.choice(user_ids), 'title': f"item {i}",
+                             'description': 'load test listing',
+                             'price': Decimal(rng.randint(100, 10000)) / 100,
+                             'created_at': created_at, 'updated_at': created_at, 'status': 'active'})
+            db.session.execute(db.insert(Listing), rows)
+            db.session.commit()
+
+        listing_ids = list(db.session.scalars(db.select(Listing.id)))
+        headers = {user_id: {'Authorization': f"Bearer {create_access_token(identity=str(user_id))}"}
+                   for user_id in user_ids}
+
+    return {
+        'user_ids': user_ids,
+        'emails': dict(users),
+        'headers': headers,
+        'listing_ids': listing_ids,
+        'pages': max(1, math.ceil(len(listing_ids) / app.config['DEFAULT_PER_PAGE'])),
+    }
+
+
+def percentile(values, q):
+    # nearest-rank, values must be sorted
+    if not values:
+        return None
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def summarize(samples, elapsed):
+    latencies = sorted(latency for latency, _, _ in samples)
+    queries = [count for _, _, count in samples if count is not None]
+    statuses = Counter(status for _, status, _ in samples)
+    return {
+        'requests': len(samples),
+        'rps': round(len(samples) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'errors': sum(count for status, count in statuses.items() if status >= 500),
+        'status_codes': {str(status): count for status, count in sorted(statuses.items())},
+    }
+
+
+def run(app, args, state):
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    samples = defaultdict(list)
+    samples_lock = threading.Lock()
+    start = threading.Barrier(args.threads + 1)
+    deadline = None
+
+    def worker(worker_seed):
+        rng = random.Random(worker_seed)
+        client = app.test_client()
+        local = defaultdict(list)
+        start.wait()
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            started_at = time.perf_counter()
+            response = OPERATIONS[name](client, rng, state)
+            latency = time.perf_counter() - started_at
+            query_count = response.headers.get('X-Query-Count')
+            local[name].append((latency, response.status_code,
+                                int(query_count) if query_count is not None else None))
+        with samples_lock:
+            for name, values in local.items():
+                samples[name].extend(values)
+
+    threads = [threading.Thread(target=worker, args=(args.seed + i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    deadline = time.perf_counter() + args.duration
+    start.wait()
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+
+    endpoints = {name: summarize(values, elapsed) for name, values in sorted(samples.items())}
+    total = summarize([sample for values in samples.values() for sample in values], elapsed)
+    return elapsed, endpoints, total
+
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    print(f"\n{'vs baseline':<10} {'p95':>22} {'req/s':>22}")
+    for name, current in results['endpoints'].items():
+        previous = baseline['endpoints'].get(name)
+        if not previous:
+            continue
+        p95_change = (current['p95_ms'] - previous['p95_ms']) / previous['p95_ms'] * 100
+        rps_change = (current['rps'] - previous['rps']) / previous['rps'] * 100
+        print(f"{name:<10} {previous['p95_ms']:>8} -> {current['p95_ms']:>8} {p95_change:+5.0f}%"
+              f" {previous['rps']:>8} -> {current['rps']:>8} {rps_change:+5.0f}%")
+        if p95_change > max_regression or -rps_change > max_regression:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    args = parse_args()
+    if args.database_uri:
+        os.environ['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'loadtest.db')
+        os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-secret-key-benchmark-secret-key')
+    os.environ['QUERY_COUNT_HEADER'] = 'true'
+    # every simulated client shares one address, the per-client buckets would throttle the run
+    os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+    # seeded users must not be rehashed to the default method on their first login
+    os.environ['PASSWORD_HASH_METHOD'] = args.password_hash_method
+    if args.no_cache:
+        os.environ['RESPONSE_CACHE_BACKEND'] = 'none'
+
+    from app import create_app
+
+    app = create_app()
+    seeding_started_at = time.perf_counter()
+    state = seed(app, args)
+    print(f"seeded {len(state['user_ids'])} users and {len(state['listing_ids'])} listings "
+          f"in {time.perf_counter() - seeding_started_at:.1f}s")
+
+    elapsed, endpoints, total = run(app, args, state)
+
+    print(f"\n{'endpoint':<10} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+          f" {'queries':>8} {'5xx':>5}")
+    for name, stats in [*endpoints.items(), ('total', total)]:
+        print(f"{name:<10} {stats['requests']:>9} {stats['rps']:>8} {stats['p50_ms']:>8} {stats['p95_ms']:>8}"
+              f" {stats['p99_ms']:>8} {stats['queries_per_request'] or '-':>8} {stats['errors']:>5}")
+
+    results = {
+        'config': {
+            'users': args.users,
+            'listings': args.listings,
+            'threads': args.threads,
+            'duration': round(elapsed, 2),
+            'mix': args.mix,
+            'seed': args.seed,
+            'password_hash_method': args.password_hash_method,
+            'response_cache': not args.no_cache,
+            'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+        },
+        'endpoints': endpoints,
+        'total': total,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print(f"\nREGRESSED: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,121 @@
+# Hammers buy_listing from many threads and checks that no listing is sold
+# twice and no balance update is lost.
+#
+#   python -m benchmarks.purchase_race --threads 16 --buyers 4 --listings 200
+#
+# Runs against a throwaway SQLite file unless --database-uri is given.
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from decimal import Decimal
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Concurrent buy_listing race benchmark")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--buyers', type=int, default=4)
+    parser.add_argument('--listings', type=int, default=200)
+    parser.add_argument('--attempts', type=int, default=50, help="purchase attempts per thread")
+    parser.add_argument('--price', default='1.00')
+    parser.add_argument('--balance', default='30.00', help="starting balance of every buyer")
+    parser.add_argument('--database-uri')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.database_uri:
+        os.environ['SQLALCHEMY_DATABASE_URI'] = args.database_uri
+    else:
+        path = os.path.join(tempfile.mkdtemp(), 'purchase_race.db')
+        os.environ['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-secret-key-benchmark-secret-key')
+    # every simulated client shares one address, the per-client buckets would throttle the run
+    os.environ.setdefault('RATE_LIMIT_BACKEND', 'none')
+
+    from app import create_app
+    from extenstions import db
+    from models import Listing, Purchase, User
+    from wallet import get_balance
+    from flask_jwt_extended import create_access_token
+
+    app = create_app()
+    price = Decimal(args.price)
+    balance = Decimal(args.balance)
+
+    with app.app_context():
+        seller = User(username='seller', email='seller@example.com', balance=0)
+        seller.set_password('seller')
+        buyers = [User(username=f"buyer{i}", email=f"buyer{i}@example.com", balance=balance)
+                  for i in range(args.buyers)]
+        for buyer in buyers:
+            buyer.set_password('buyer')
+        db.session.add_all([seller, *buyers])
+        db.session.flush()
+
+        db.session.add_all([
+            Listing(user_id=seller.id, title=f"item {i}", description='benchmark', price=price)
+            for i in range(args.listings)
+        ])
+        db.session.commit()
+
+        buyer_ids = [buyer.id for buyer in buyers]
+        listing_ids = [listing_id for (listing_id,) in db.session.query(Listing.id)]
+        tokens = {buyer_id: create_access_token(identity=str(buyer_id)) for buyer_id in buyer_ids}
+
+    statuses = Counter()
+    statuses_lock = threading.Lock()
+    start = threading.Barrier(args.threads)
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        local = Counter()
+        start.wait()
+        for _ in range(args.attempts):
+            buyer_id = rng.choice(buyer_ids)
+            listing_id = rng.choice(listing_ids)
+            response = client.post(f"/api/v1/listings/{listing_id}/buy",
+                                   headers={'Authorization': f"Bearer {tokens[buyer_id]}"})
+            local[response.status_code] += 1
+        with statuses_lock:
+            statuses.update(local)
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(args.threads)]
+    started_at = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started_at
+
+    with app.app_context():
+        purchases = db.session.query(Purchase.listing_id, Purchase.buyer_id).all()
+        sold = Listing.query.filter_by(status='sold').count()
+        balances = {buyer_id: get_balance(buyer_id) for buyer_id in buyer_ids}
+
+    per_listing = Counter(listing_id for listing_id, _ in purchases)
+    per_buyer = Counter(buyer_id for _, buyer_id in purchases)
+    double_sales = [listing_id for listing_id, count in per_listing.items() if count > 1]
+    lost_updates = [buyer_id for buyer_id in buyer_ids
+                    if balances[buyer_id] != balance - price * per_buyer[buyer_id]]
+
+    requests = sum(statuses.values())
+    print(f"requests:      {requests} in {elapsed:.2f}s ({requests / elapsed:.0f} req/s)")
+    print(f"purchases:     {len(purchases)} ({len(purchases) / elapsed:.0f}/s), sold listings: {sold}")
+    print(f"status codes:  {dict(sorted(statuses.items()))}")
+    print(f"double sales:  {len(double_sales)}")
+    print(f"lost updates:  {len(lost_updates)}")
+
+    ok = not double_sales and not lost_updates and sold == len(purchases) \
+        and all(value >= 0 for value in balances.values())
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,238 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+from sqlalchemy import event
+
+from extenstions import db
+from replica import has_replica, reads_from_replica, use_replica
+
+
+# In-process LRU, each worker process keeps its own entries
+class MemoryBackend:
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_versions(self, tags):
+        with self._lock:
+            return [self._versions.get(tag, 0) for tag in tags]
+
+    def bump_version(self, tag):
+        with self._lock:
+            self._versions[tag] = self._versions.get(tag, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+
+
+# Shared by every worker process on the host through one SQLite file, so an
+# invalidation in one worker is seen by all of them
+class SQLiteBackend:
+    def __init__(self, path, max_size=1024):
+        self.path = path
+        self.max_size = max_size
+        self.evictions = 0
+        self._local = threading.local()
+
+    # connections and tables are created on first use, not at startup
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache_entries ("
+                               "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL, stored_at REAL NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS cache_versions (tag TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT value FROM cache_entries WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO cache_entries (key, value, expires_at, stored_at) VALUES (?, ?, ?, ?)",
+                           (key, pickle.dumps(value), now + ttl, now))
+        connection.execute("DELETE FROM cache_entries WHERE expires_at < ?", (now,))
+        excess = connection.execute("SELECT COUNT(*) FROM cache_entries").fetchone()[0] - self.max_size
+        if excess > 0:
+            connection.execute("DELETE FROM cache_entries WHERE key IN "
+                               "(SELECT key FROM cache_entries ORDER BY stored_at LIMIT ?)", (excess,))
+            self.evictions += excess
+
+    def get_versions(self, tags):
+        connection = self._connection()
+        versions = dict(connection.execute(
+            f"SELECT tag, version FROM cache_versions WHERE tag IN ({', '.join('?' * len(tags))})", tags
+        ).fetchall()) if tags else {}
+        return [versions.get(tag, 0) for tag in tags]
+
+    def bump_version(self, tag):
+        self._connection().execute("INSERT INTO cache_versions (tag, version) VALUES (?, 1) "
+                                   "ON CONFLICT (tag) DO UPDATE SET version = version + 1", (tag,))
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute("DELETE FROM cache_entries")
+        connection.execute("DELETE FROM cache_versions")
+
+
+# Caches whole GET responses. Entries are keyed on the endpoint, its view and
+# query arguments and the current version of every tag the response depends on;
+# invalidate() bumps a tag's version so all entries built on it stop matching.
+# Per-object tags such as listing:<id> are folded into tag_buckets buckets, so
+# the version table stays bounded however many listings change; two ids that
+# share a bucket merely invalidate each other's entries.
+class ResponseCache:
+    def __init__(self):
+        self.backend = None
+        self.ttl = 60
+        self.tag_buckets = 4096
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def cached(self, *tags):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if self.backend is None or request.method != 'GET':
+                    return func(*args, **kwargs)
+
+                resolved_tags = [self.version_tag(tag(**kwargs) if callable(tag) else tag) for tag in tags]
+                versions = self.backend.get_versions(resolved_tags)
+                key = '|'.join([
+                    request.endpoint,
+                    # tags are bucketed, so they do not tell listings apart
+                    repr(sorted(kwargs.items())),
+                    repr(sorted(request.args.items(multi=True))),
+                    *(f"{tag}={version}" for tag, version in zip(resolved_tags, versions))
+                ])
+
+                # with a replica, callers pinned to the primary skip the lookup so
+                # they see their own writes, and only primary reads are stored; a
+                # lagging replica would be cached under the new tag versions
+                pinned = has_replica() and not use_replica()
+                entry = None if pinned else self.backend.get(key)
+                if entry is not None:
+                    self._count(hit=True)
+                    body, mimetype, etag = entry
+                    response = current_app.response_class(body, mimetype=mimetype)
+                    response.headers['X-Cache'] = 'HIT'
+                else:
+                    self._count(hit=False)
+                    response = current_app.make_response(func(*args, **kwargs))
+                    if response.status_code != 200:
+                        return response
+                    body = response.get_data()
+                    etag = hashlib.sha256(body).hexdigest()
+                    if not reads_from_replica():
+                        self.backend.set(key, (body, response.mimetype, etag), self.ttl)
+                    response.headers['X-Cache'] = 'BYPASS' if pinned else 'MISS'
+
+                response.set_etag(etag)
+                return response.make_conditional(request)
+            return wrapper
+        return decorator
+
+    def version_tag(self, tag):
+        kind, separator, name = tag.partition(':')
+        if not separator:
+            return tag
+        # crc32 rather than hash(), the bucket has to match in every worker
+        return f"{kind}:#{zlib.crc32(name.encode()) % self.tag_buckets}"
+
+    def invalidate(self, *tags):
+        if self.backend is None:
+            return
+        for tag in {self.version_tag(tag) for tag in tags}:
+            self.backend.bump_version(tag)
+
+    def invalidate_on_commit(self, *tags):
+        """Invalidate `tags` once the session's current transaction commits."""
+        db.session.info.setdefault('invalidate_tags', set()).update(tags)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.backend.evictions if self.backend else 0
+        }
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+response_cache = ResponseCache()
+
+
+def invalidate_committed(session):
+    tags = session.info.pop('invalidate_tags', None)
+    if tags:
+        response_cache.invalidate(*tags)
+
+
+def discard_invalidations(session):
+    session.info.pop('invalidate_tags', None)
+
+
+def init_cache(app):
+    backend = app.config['RESPONSE_CACHE_BACKEND']
+    size = app.config['RESPONSE_CACHE_SIZE']
+    if backend == 'memory':
+        response_cache.backend = MemoryBackend(size)
+    elif backend == 'sqlite':
+        response_cache.backend = SQLiteBackend(app.config['RESPONSE_CACHE_PATH'], size)
+    elif backend == 'none':
+        response_cache.backend = None
+    else:
+        raise ValueError(f"Unknown RESPONSE_CACHE_BACKEND: {backend}")
+    response_cache.ttl = app.config['RESPONSE_CACHE_TTL']
+    response_cache.tag_buckets = app.config['RESPONSE_CACHE_TAG_BUCKETS']
+
+    if not event.contains(db.session, 'after_commit', invalidate_committed):
+        event.listen(db.session, 'after_commit', invalidate_committed)
+        event.listen(db.session, 'after_rollback', discard_invalidations)
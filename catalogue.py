@@ -0,0 +1,154 @@
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from itertools import combinations
+
+from extenstions import db
+from models import Listing
+
+# sort name -> (column, parser for the value stored in a cursor). Every sort
+# also orders by id so keyset pagination has a unique position.
+LISTING_SORTS = {
+    'id': (Listing.id, int),
+    'created_at': (Listing.created_at, datetime.fromisoformat),
+    'price': (Listing.price, Decimal)
+}
+
+LISTING_FILTERS = ('status', 'user_id', 'min_price', 'max_price', 'created_after', 'created_before')
+
+
+def parse_sort(value, default):
+    value = value or default
+    name = value.lstrip('-')
+    if name not in LISTING_SORTS:
+        choices = ', '.join(f"{name}, -{name}" for name in LISTING_SORTS)
+        raise ValueError(f"sort must be one of: {choices}")
+    return name, value.startswith('-')
+
+
+def parse_listing_filters(args):
+    filters = {}
+    if args.get('status'):
+        filters['status'] = args['status']
+
+    if args.get('user_id'):
+        try:
+            filters['user_id'] = int(args['user_id'])
+        except ValueError as e:
+            raise ValueError("user_id must be an integer.") from e
+
+    for name in ('min_price', 'max_price'):
+        if args.get(name):
+            try:
+                filters[name] = Decimal(args[name])
+            except InvalidOperation as e:
+                raise ValueError(f"{name} must be a number.") from e
+
+    for name in ('created_after', 'created_before'):
+        if args.get(name):
+            try:
+                filters[name] = datetime.fromisoformat(args[name])
+            except ValueError as e:
+                raise ValueError(f"{name} must be an ISO 8601 date or datetime.") from e
+
+    return filters
+
+
+def filter_listings(statement, filters):
+    if 'status' in filters:
+        statement = statement.where(Listing.status == filters['status'])
+    if 'user_id' in filters:
+        statement = statement.where(Listing.user_id == filters['user_id'])
+    if 'min_price' in filters:
+        statement = statement.where(Listing.price >= filters['min_price'])
+    if 'max_price' in filters:
+        statement = statement.where(Listing.price <= filters['max_price'])
+    if 'created_after' in filters:
+        statement = statement.where(Listing.created_at >= filters['created_after'])
+    if 'created_before' in filters:
+        statement = statement.where(Listing.created_at < filters['created_before'])
+    return statement
+
+
+def sort_keys(sort):
+    column = LISTING_SORTS[sort][0]
+    return (column,) if column is Listing.id else (column, Listing.id)
+
+
+def sort_listings(statement, sort, descending):
+    return statement.order_by(*(key.desc() if descending else key for key in sort_keys(sort)))
+
+
+def listings_after(statement, sort, descending, values):
+    # values are the raw sort key values of the last row of the previous page
+    keys = sort_keys(sort)
+    if len(values) != len(keys):
+        raise ValueError("Invalid cursor.")
+    try:
+        position = [LISTING_SORTS[sort][1](values[0]), *map(int, values[1:])]
+    except (TypeError, ValueError, InvalidOperation) as e:
+        raise ValueError("Invalid cursor.") from e
+
+    if len(keys) == 1:
+        left, right = keys[0], position[0]
+    else:
+        left, right = db.tuple_(*keys), db.tuple_(*position)
+    return statement.where(left < right if descending else left > right)
+
+
+def cursor_page(statement, filters, sort, descending, position, limit):
+    """One cursor-mode page, after `position` (raw cursor values) or from the start when it is None."""
+    statement = filter_listings(statement, filters)
+    if position is not None:
+        statement = listings_after(statement, sort, descending, position)
+    return sort_listings(statement, sort, descending).limit(limit)
+
+
+def supported_queries():
+    # every combination of filters with every sort, for the first cursor page
+    # and for one with a cursor set. Filters and sorts are only accepted in
+    # cursor mode, page mode always lists every row by id.
+    samples = {
+        'status': 'active',
+        'user_id': 1,
+        'min_price': Decimal('1'),
+        'max_price': Decimal('100'),
+        'created_after': datetime(2024, 1, 1),
+        'created_before': datetime(2025, 1, 1)
+    }
+    cursor_samples = {'id': ['1'], 'created_at': ['2024-06-01T00:00:00', '1'], 'price': ['10', '1']}
+
+    groups = [('status',), ('user_id',), ('min_price', 'max_price'), ('created_after', 'created_before')]
+    for size in range(len(groups) + 1):
+        for chosen in combinations(groups, size):
+            filters = {name: samples[name] for group in chosen for name in group}
+            for sort in LISTING_SORTS:
+                for descending in (False, True):
+                    for page, position in (('first', None), ('next', cursor_samples[sort])):
+                        statement = cursor_page(db.select(Listing.id), filters, sort, descending, position, 21)
+                        label = (f"filters={','.join(filters) or '-'} "
+                                 f"sort={'-' if descending else ''}{sort} page={page}")
+                        yield label, statement
+
+
+def explain(statement):
+    dialect = db.session.get_bind().dialect
+    compiled = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+    if dialect.name == 'sqlite':
+        rows = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+        plan = [row[-1] for row in rows]
+        # SCAN walks the whole table or a whole index, SEARCH seeks into one.
+        # An unfiltered page is the exception: walking an index in sort order,
+        # with no sort step after it, stops at the page's LIMIT.
+        ordered_walk = statement.whereclause is None and not any('TEMP B-TREE' in line for line in plan)
+        full_scan = not ordered_walk and any(line.startswith('SCAN listings') for line in plan)
+    elif dialect.name == 'postgresql':
+        # with sequential scans disabled the planner only falls back to one
+        # when no index can answer the query
+        db.session.execute(db.text("SET LOCAL enable_seqscan = off"))
+        plan = [row[0] for row in db.session.execute(db.text(f"EXPLAIN {compiled}")).all()]
+        full_scan = any('Seq Scan on listings' in line for line in plan)
+        db.session.rollback()
+    else:
+        raise ValueError(f"EXPLAIN is not supported on {dialect.name}.")
+    return plan, full_scan
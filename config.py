@@ -5,4 +5,134 @@ from dotenv import load_dotenv
 load_dotenv()
 
 SQLALCHEMY_DATABASE_URI = os.environ.get("SQLALCHEMY_DATABASE_URI")
-JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
\ No newline at end of file
+JWT_SECRET_KEY = os.environ.get("JWT_SECRET_KEY")
+
+# Optional read replica. GET requests read from it unless the caller wrote
+# within the last REPLICA_STICKY_SECONDS
+REPLICA_DATABASE_URI = os.environ.get("REPLICA_DATABASE_URI")
+SQLALCHEMY_BINDS = {"replica": REPLICA_DATABASE_URI} if REPLICA_DATABASE_URI else {}
+REPLICA_STICKY_SECONDS = int(os.environ.get("REPLICA_STICKY_SECONDS", 5))
+
+# Create the schema and seed roles on every boot; turn off for pre-forked
+# workers and run `flask init-db` once instead
+DB_AUTO_INIT = os.environ.get("DB_AUTO_INIT", "true").lower() == "true"
+
+# Pagination limits, per_page is clamped server-side to MAX_PER_PAGE
+DEFAULT_PER_PAGE = int(os.environ.get("DEFAULT_PER_PAGE", 20))
+MAX_PER_PAGE = int(os.environ.get("MAX_PER_PAGE", 100))
+
+# Cache of authenticated users shared across requests of one worker process
+PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", 1024))
+PRINCIPAL_CACHE_TTL = int(os.environ.get("PRINCIPAL_CACHE_TTL", 60))
+
+# Seconds before the in-memory role -> permissions index is rebuilt, changes
+# made through this worker invalidate it immediately
+PERMISSION_INDEX_TTL = int(os.environ.get("PERMISSION_INDEX_TTL", 300))
+
+# Password hashing runs in a process pool of PASSWORD_HASH_WORKERS processes
+# (0 hashes inline). Logins beyond PASSWORD_HASH_QUEUE_SIZE in flight get a 503.
+# Changing PASSWORD_HASH_METHOD rehashes passwords on the next successful login.
+PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD", "pbkdf2:sha256:1000000")
+PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_QUEUE_SIZE = int(os.environ.get("PASSWORD_HASH_QUEUE_SIZE", 16))
+PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 5))
+PASSWORD_HASH_RETRY_AFTER = int(os.environ.get("PASSWORD_HASH_RETRY_AFTER", 1))
+
+# Bulk listing import
+BULK_INSERT_BATCH_SIZE = int(os.environ.get("BULK_INSERT_BATCH_SIZE", 1000))
+BULK_MAX_REPORTED_ERRORS = int(os.environ.get("BULK_MAX_REPORTED_ERRORS", 100))
+
+# Rows fetched per round trip by the streaming export endpoints
+EXPORT_CHUNK_SIZE = int(os.environ.get("EXPORT_CHUNK_SIZE", 1000))
+
+# Response cache for public listing reads. "memory" is per worker process,
+# "sqlite" shares entries and invalidations between all workers on the host
+# through RESPONSE_CACHE_PATH, "none" disables caching. Per-listing
+# invalidation tags share RESPONSE_CACHE_TAG_BUCKETS version counters.
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 60))
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "/tmp/easybuy-response-cache.db")
+RESPONSE_CACHE_TAG_BUCKETS = int(os.environ.get("RESPONSE_CACHE_TAG_BUCKETS", 4096))
+
+# Largest number of listings accepted by one /listings/checkout call
+CHECKOUT_MAX_ITEMS = int(os.environ.get("CHECKOUT_MAX_ITEMS", 100))
+
+# Request and SQL instrumentation, exposed on /metrics
+SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS", 200))
+QUERY_COUNT_HEADER = os.environ.get("QUERY_COUNT_HEADER", "false").lower() == "true"
+
+# Engine and pool profiles, picked with ENGINE_PROFILE. The sqlite and
+# postgresql entries are applied to every new connection of that dialect
+ENGINE_PROFILE = os.environ.get("ENGINE_PROFILE", "dev-sqlite")
+ENGINE_PROFILES = {
+    "dev-sqlite": {
+        "pool_size": 5,
+        "max_overflow": 10,
+        "pool_timeout": 30,
+        "pool_recycle": -1,
+        "pool_pre_ping": False,
+        "query_cache_size": 500,
+        "sqlite": {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000},
+        "postgresql": {},
+    },
+    "prod-pooled": {
+        "pool_size": 10,
+        "max_overflow": 5,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "query_cache_size": 1200,
+        "sqlite": {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 5000},
+        "postgresql": {"statement_timeout": "15s", "idle_in_transaction_session_timeout": "60s"},
+    },
+    "high-concurrency": {
+        "pool_size": 20,
+        "max_overflow": 20,
+        "pool_timeout": 2,
+        "pool_recycle": 900,
+        "pool_pre_ping": True,
+        "query_cache_size": 2000,
+        "sqlite": {"journal_mode": "WAL", "synchronous": "NORMAL", "busy_timeout": 2000},
+        "postgresql": {"statement_timeout": "5s", "lock_timeout": "2s",
+                       "idle_in_transaction_session_timeout": "30s"},
+    },
+}
+
+# Background jobs. JOB_WORKERS threads per process start on the first
+# enqueue; with 0, run `flask jobs work` instead
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", 1))
+JOB_STALE_AFTER = int(os.environ.get("JOB_STALE_AFTER", 300))
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+JOB_BATCH_SIZE = int(os.environ.get("JOB_BATCH_SIZE", 500))
+
+# Sold listings are moved to archived_listings this long after the sale,
+# by `flask lifecycle archive` or an archive_listings job
+LISTING_ARCHIVE_AFTER_DAYS = int(os.environ.get("LISTING_ARCHIVE_AFTER_DAYS", 30))
+
+# Analytics rollups, run `flask rollups run` (or a run_rollups job) on a
+# schedule. Rows younger than ROLLUP_SETTLE_SECONDS wait for the next run
+ROLLUP_BATCH_SIZE = int(os.environ.get("ROLLUP_BATCH_SIZE", 5000))
+ROLLUP_SETTLE_SECONDS = int(os.environ.get("ROLLUP_SETTLE_SECONDS", 60))
+
+# Responses to requests carrying an Idempotency-Key are replayed for this
+# long; `flask idempotency sweep` removes older keys
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 86400))
+
+# Admission control. Each client (JWT identity, else remote address) gets a
+# token bucket of (tokens per second, burst) per endpoint class. "memory"
+# buckets are per worker process, "sqlite" shares them between all workers
+# on the host through RATE_LIMIT_PATH, "none" turns rate limiting off
+RATE_LIMIT_BACKEND = os.environ.get("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_PATH = os.environ.get("RATE_LIMIT_PATH", "/tmp/easybuy-rate-limits.db")
+RATE_LIMITS = {
+    "auth": (float(os.environ.get("RATE_LIMIT_AUTH_RATE", 0.2)), int(os.environ.get("RATE_LIMIT_AUTH_BURST", 10))),
+    "write": (float(os.environ.get("RATE_LIMIT_WRITE_RATE", 5)), int(os.environ.get("RATE_LIMIT_WRITE_BURST", 20))),
+    "read": (float(os.environ.get("RATE_LIMIT_READ_RATE", 20)), int(os.environ.get("RATE_LIMIT_READ_BURST", 60))),
+}
+
+# Requests admitted at once per process before the rest get a 503. -1 sizes
+# it to the pool (pool_size + max_overflow of ENGINE_PROFILE), 0 disables it
+LOAD_SHED_MAX_IN_FLIGHT = int(os.environ.get("LOAD_SHED_MAX_IN_FLIGHT", -1))
+LOAD_SHED_RETRY_AFTER = int(os.environ.get("LOAD_SHED_RETRY_AFTER", 1))
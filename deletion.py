@@ -0,0 +1,63 @@
+from cache import response_cache
+from extenstions import db
+from jobs import delete_in_batches, job
+from models import ArchivedListing, Listing, Purchase, User, UserStats, WalletEntry, user_roles
+from principal import principal_cache
+from stats import adjust_stats
+
+
+def invalidate_listings(listing_ids):
+    response_cache.invalidate('listings', *(f"listing:{listing_id}" for listing_id in listing_ids))
+
+
+def forget_purchases(purchase_ids):
+    # the buyers keep their stats, minus the purchases about to be deleted
+    price = db.func.coalesce(Listing.price, ArchivedListing.price)
+    bought = db.session.execute(
+        db.select(Purchase.buyer_id, db.func.count(), db.func.sum(price))
+        .outerjoin(Purchase.listing)
+        .outerjoin(Purchase.archived_listing)
+        .where(Purchase.id.in_(purchase_ids))
+        .group_by(Purchase.buyer_id)
+    )
+    adjust_stats({buyer_id: {'purchases': -count, 'total_spent': -(spent or 0)} for buyer_id, count, spent in bought})
+
+
+# The cascades delete with plain DELETE ... WHERE id IN (batch) statements
+# instead of session.delete, which would load every related row first. They
+# are safe to re-run after a crash, rows already gone are simply not found.
+
+@job('delete_listing')
+def delete_listing_cascade(ctx, listing_id):
+    # only listings that were never sold are flipped to 'deleted', so there
+    # are no purchases to remove with them
+    ctx.set_total(1)
+    db.session.execute(db.delete(Listing).where(Listing.id == listing_id, Listing.status == 'deleted'))
+    ctx.advance(1)
+    invalidate_listings([listing_id])
+
+
+@job('delete_user')
+def delete_user_cascade(ctx, user_id):
+    own_listings = db.union_all(db.select(Listing.id).where(Listing.user_id == user_id),
+                                db.select(ArchivedListing.id).where(ArchivedListing.user_id == user_id))
+    counts = [
+        db.select(db.func.count()).where(Purchase.buyer_id == user_id),
+        db.select(db.func.count()).where(Purchase.listing_id.in_(own_listings)),
+        db.select(db.func.count()).where(Listing.user_id == user_id),
+        db.select(db.func.count()).where(ArchivedListing.user_id == user_id),
+        db.select(db.func.count()).where(WalletEntry.user_id == user_id),
+    ]
+    ctx.set_total(sum(db.session.scalar(count) for count in counts) + 1)
+
+    delete_in_batches(ctx, Purchase, Purchase.buyer_id == user_id)
+    delete_in_batches(ctx, Purchase, Purchase.listing_id.in_(own_listings), on_batch=forget_purchases)
+    delete_in_batches(ctx, Listing, Listing.user_id == user_id, on_batch=invalidate_listings)
+    delete_in_batches(ctx, ArchivedListing, ArchivedListing.user_id == user_id, on_batch=invalidate_listings)
+    delete_in_batches(ctx, WalletEntry, WalletEntry.user_id == user_id)
+
+    db.session.execute(db.delete(user_roles).where(user_roles.c.user_id == user_id))
+    db.session.execute(db.delete(UserStats).where(UserStats.user_id == user_id))
+    db.session.execute(db.delete(User).where(User.id == user_id))
+    ctx.advance(1)
+    principal_cache.invalidate(user_id)
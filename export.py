@@ -0,0 +1,69 @@
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+
+from flask import Response, current_app, request, stream_with_context
+
+from extenstions import db
+
+EXPORT_MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+
+
+def export_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def get_export_format():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_MIMETYPES:
+        raise ValueError(f"format must be one of: {', '.join(EXPORT_MIMETYPES)}")
+    return export_format
+
+
+def stream_export(statement, export_format, filename):
+    # rows are fetched chunk_size at a time (a server-side cursor on
+    # PostgreSQL) and written out before the next chunk is read, so memory
+    # does not grow with the export and the first rows go out right away
+    chunk_size = current_app.config['EXPORT_CHUNK_SIZE']
+    columns = [column.name for column in statement.selected_columns]
+
+    def generate_ndjson(result):
+        for rows in result.partitions():
+            yield ''.join(
+                json.dumps(dict(zip(columns, map(export_value, row)))) + '\n'
+                for row in rows
+            )
+
+    def generate_csv(result):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for rows in result.partitions():
+            writer.writerows(map(export_value, row) for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    def generate():
+        result = db.session.execute(statement.execution_options(yield_per=chunk_size))
+        try:
+            if export_format == 'csv':
+                yield from generate_csv(result)
+            else:
+                yield from generate_ndjson(result)
+        finally:
+            result.close()
+
+    response = Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = f"attachment; filename={filename}.{export_format}"
+    return response
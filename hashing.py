@@ -0,0 +1,135 @@
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+
+
+class HasherBusy(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Password hashing queue is full.")
+        self.retry_after = retry_after
+
+
+def normalize_method(method):
+    """The method prefix werkzeug stores for `method`, with its defaults filled in."""
+    name, *args = method.split(':')
+    if name == 'pbkdf2' and len(args) < 2:
+        return f"pbkdf2:{args[0] if args else 'sha256'}:{DEFAULT_PBKDF2_ITERATIONS}"
+    if name == 'scrypt' and not args:
+        return f"scrypt:{2 ** 15}:8:1"
+    return method
+
+
+def _timed(func, *args):
+    # returns the CPU time of the calling thread next to the result; that is
+    # the pool process, or the request thread when hashing inline
+    start = time.thread_time()
+    result = func(*args)
+    return result, time.thread_time() - start
+
+
+# PBKDF2 is deliberately slow, so it runs in a small process pool instead of
+# on the request worker. At most queue_size calls may be in flight, anything
+# above that is rejected right away with HasherBusy.
+class PasswordHasher:
+    def __init__(self):
+        self.method = 'pbkdf2:sha256:1000000'
+        self.workers = 0
+        self.queue_size = 0
+        self.timeout = None
+        self.retry_after = 1
+        self._pool = None
+        self._prefix = normalize_method(self.method)
+        self._slots = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def configure(self, method, workers, queue_size, timeout, retry_after):
+        self.method = method
+        self._prefix = normalize_method(method)
+        self.workers = workers
+        self.queue_size = max(queue_size, workers)
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._slots = threading.BoundedSemaphore(self.queue_size) if workers else None
+
+    def hash(self, password):
+        return self._run('hash', generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run('verify', check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        # werkzeug fills in defaults ('pbkdf2:sha256' is stored as
+        # 'pbkdf2:sha256:<iterations>'), so compare against the normalized method
+        return password_hash.split('$', 1)[0] != self._prefix
+
+    def stats(self):
+        with self._lock:
+            return {operation: dict(values) for operation, values in self._stats.items()}
+
+    def _run(self, operation, func, *args):
+        start = time.perf_counter()
+        if not self.workers:
+            result, cpu_time = _timed(func, *args)
+            self._record(operation, time.perf_counter() - start, cpu_time)
+            return result
+
+        if not self._slots.acquire(blocking=False):
+            self._record(operation, rejected=True)
+            raise HasherBusy(self.retry_after)
+        try:
+            future = self._get_pool().submit(_timed, func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # the slot is freed when the work finishes, not when the caller stops
+        # waiting, so a timed-out hash still counts against queue_size
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            result, cpu_time = future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            self._record(operation, rejected=True)
+            raise HasherBusy(self.retry_after)
+
+        self._record(operation, time.perf_counter() - start, cpu_time)
+        return result
+
+    def _get_pool(self):
+        # spawn instead of fork, the pool is started lazily from a web process
+        # that may already be running threads
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def _record(self, operation, wall_time=0.0, cpu_time=0.0, rejected=False):
+        with self._lock:
+            stats = self._stats.setdefault(operation, {
+                'count': 0, 'rejected': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'max_wall_seconds': 0.0
+            })
+            if rejected:
+                stats['rejected'] += 1
+                return
+            stats['count'] += 1
+            stats['wall_seconds'] += wall_time
+            stats['cpu_seconds'] += cpu_time
+            stats['max_wall_seconds'] = max(stats['max_wall_seconds'], wall_time)
+
+
+password_hasher = PasswordHasher()
+
+
+def init_hasher(app):
+    password_hasher.configure(
+        method=app.config['PASSWORD_HASH_METHOD'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        queue_size=app.config['PASSWORD_HASH_QUEUE_SIZE'],
+        timeout=app.config['PASSWORD_HASH_TIMEOUT'],
+        retry_after=app.config['PASSWORD_HASH_RETRY_AFTER']
+    )
@@ -0,0 +1,155 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+
+import click
+from flask import current_app, jsonify, make_response, request
+from flask.cli import AppGroup
+from flask_jwt_extended import get_jwt_identity
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
+
+from extenstions import db
+from jobs import job
+from models import IdempotencyKey
+
+idempotency_cli = AppGroup('idempotency', help="Idempotency key store.")
+
+MAX_KEY_LENGTH = 255
+
+
+def key_hash(identity, key):
+    return hashlib.sha256(f"{identity}\0{key}".encode()).hexdigest()
+
+
+def request_hash():
+    digest = hashlib.sha256(f"{request.method} {request.path}\0".encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def replay(record, fingerprint):
+    if record.request_hash != fingerprint:
+        return jsonify({
+            "status": "error",
+            "message": "This Idempotency-Key was already used for a different request."
+        }), 422
+    if record.status_code is None:
+        # the key and its response commit together, so this is only seen
+        # if a view commits on its own before returning
+        response = jsonify({
+            "status": "error",
+            "message": "A request with this Idempotency-Key is still in progress."
+        })
+        response.headers['Retry-After'] = '1'
+        return response, 409
+
+    response = current_app.response_class(record.response_body, status=record.status_code,
+                                          mimetype='application/json')
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def find_key(hashed):
+    record = db.session.get(IdempotencyKey, hashed)
+    if record is not None and record.expires_at <= datetime.utcnow():
+        # expired but not swept yet, the key is free again
+        db.session.delete(record)
+        db.session.commit()
+        return None
+    return record
+
+
+def idempotent(func):
+    """Replay the stored response when a request repeats its Idempotency-Key.
+
+    Goes below @jwt_required(). The decorated view does not commit: the key
+    row is flushed before it runs, the response is written to the row after
+    it returns, and the decorator then commits the view's changes, the key
+    and its response together. A key is therefore never stored without its
+    response, nor a response without the mutation it reports. A concurrent
+    duplicate blocks on the key's primary key and is answered from the row.
+    """
+    def run(*args, **kwargs):
+        response = make_response(func(*args, **kwargs))
+        db.session.commit()
+        return response
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return run(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({
+                "status": "error",
+                "message": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters."
+            }), 400
+
+        hashed = key_hash(get_jwt_identity(), key)
+        fingerprint = request_hash()
+        # a retry costs this one primary key lookup
+        record = find_key(hashed)
+        if record is not None:
+            return replay(record, fingerprint)
+
+        now = datetime.utcnow()
+        record = IdempotencyKey(key_hash=hashed, request_hash=fingerprint, created_at=now,
+                                expires_at=now + timedelta(seconds=current_app.config['IDEMPOTENCY_TTL']))
+        db.session.add(record)
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            record = find_key(hashed)
+            if record is None:
+                return run(*args, **kwargs)
+            return replay(record, fingerprint)
+
+        response = make_response(func(*args, **kwargs))
+
+        # a view that rolled back took the key row with it, a retry runs again
+        if inspect(record).persistent:
+            record.status_code = response.status_code
+            record.response_body = response.get_data(as_text=True)
+        db.session.commit()
+        return response
+    return wrapper
+
+
+def sweep(batch_size, on_batch=None):
+    """Delete expired keys batch_size at a time, return how many were removed."""
+    removed = 0
+    while True:
+        hashes = db.session.scalars(
+            db.select(IdempotencyKey.key_hash)
+            .where(IdempotencyKey.expires_at <= datetime.utcnow())
+            .order_by(IdempotencyKey.expires_at)
+            .limit(batch_size)
+        ).all()
+        if not hashes:
+            return removed
+        db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.key_hash.in_(hashes)))
+        if on_batch:
+            on_batch(len(hashes))
+        db.session.commit()
+        removed += len(hashes)
+
+
+@job('sweep_idempotency_keys')
+def sweep_job(ctx):
+    sweep(ctx.batch_size, on_batch=ctx.advance)
+
+
+@idempotency_cli.command('sweep')
+@click.option('--batch-size', default=1000, show_default=True, help="Keys deleted per commit.")
+@click.option('--queue', is_flag=True, help="Enqueue a sweep job instead of running it here.")
+def sweep_command(batch_size, queue):
+    """Delete idempotency keys past IDEMPOTENCY_TTL."""
+    if queue:
+        queued = sweep_job.enqueue()
+        db.session.commit()
+        click.echo(f"Queued job {queued.id}.")
+        return
+
+    click.echo(f"Removed {sweep(batch_size)} expired idempotency keys.")
@@ -0,0 +1,219 @@
+import os
+import threading
+from datetime import datetime, timedelta
+from functools import partial
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event
+
+from extenstions import db
+from models import Job
+
+jobs_cli = AppGroup('jobs', help="Background job queue.")
+
+JOB_HANDLERS = {}
+
+
+def job(kind):
+    """Register a handler for `kind`, called as handler(ctx, **payload).
+
+    The handler gets `enqueue` attached, so callers can write
+    delete_user_cascade.enqueue(created_by=..., user_id=...).
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        func.enqueue = partial(enqueue, kind)
+        return func
+    return decorator
+
+
+def enqueue(kind, created_by=None, **payload):
+    # added to the caller's transaction, workers see it once that commits
+    new_job = Job(kind=kind, payload=payload, created_by=created_by)
+    db.session.add(new_job)
+    db.session.flush()
+    db.session.info['jobs_enqueued'] = True
+    return new_job
+
+
+class JobContext:
+    def __init__(self, job_id, batch_size):
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self.progress = 0
+
+    def set_total(self, total):
+        db.session.execute(db.update(Job).where(Job.id == self.job_id).values(total=total))
+        db.session.commit()
+
+    def advance(self, count):
+        """Record `count` more units of work, committing the batch with it."""
+        self.progress += count
+        db.session.execute(db.update(Job).where(Job.id == self.job_id)
+                           .values(progress=self.progress, heartbeat_at=datetime.utcnow()))
+        db.session.commit()
+
+
+def delete_in_batches(ctx, model, condition, on_batch=None):
+    """Delete matching rows ctx.batch_size at a time, one commit per batch."""
+    while True:
+        ids = db.session.scalars(db.select(model.id).where(condition).limit(ctx.batch_size)).all()
+        if not ids:
+            return
+        # on_batch runs in the batch's transaction, before the rows are gone
+        if on_batch:
+            on_batch(ids)
+        db.session.execute(db.delete(model).where(model.id.in_(ids)).execution_options(synchronize_session=False))
+        ctx.advance(len(ids))
+
+
+# Jobs live in the jobs table, so any process can claim them: the worker
+# threads started here, or `flask jobs work`. A running job whose heartbeat
+# is older than stale_after is assumed dead and claimed again.
+class JobQueue:
+    def __init__(self):
+        self.app = None
+        self.workers = 0
+        self.poll_interval = 1.0
+        self.stale_after = 300
+        self.max_attempts = 3
+        self.batch_size = 500
+        self._threads = []
+        self._pid = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+
+    def configure(self, app, workers, poll_interval, stale_after, max_attempts, batch_size):
+        self.app = app
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+
+    def notify(self):
+        self._ensure_workers()
+        self._wake.set()
+
+    def _ensure_workers(self):
+        # threads are started on the first enqueue, not at import or startup
+        if not self.workers or self.app is None:
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._threads = []
+                self._pid = os.getpid()
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self.work, args=(self.app,), daemon=True,
+                                          name=f"job-worker-{len(self._threads)}")
+                thread.start()
+                self._threads.append(thread)
+
+    def _runnable(self):
+        stale = datetime.utcnow() - timedelta(seconds=self.stale_after)
+        return db.or_(Job.status == 'queued',
+                      db.and_(Job.status == 'running', Job.heartbeat_at < stale))
+
+    def claim(self):
+        """Return the id of a newly claimed job, or None when nothing is runnable."""
+        while True:
+            job_id = db.session.scalar(db.select(Job.id).where(self._runnable()).order_by(Job.id).limit(1))
+            if job_id is None:
+                db.session.commit()
+                return None
+            # another worker may have taken it between the select and the update
+            now = datetime.utcnow()
+            claimed = db.session.execute(
+                db.update(Job).where(Job.id == job_id, self._runnable())
+                .values(status='running', started_at=now, heartbeat_at=now, attempts=Job.attempts + 1)
+            ).rowcount
+            db.session.commit()
+            if claimed:
+                return job_id
+
+    def run(self, job_id):
+        claimed = db.session.get(Job, job_id)
+        kind, payload, attempts = claimed.kind, dict(claimed.payload), claimed.attempts
+        db.session.commit()
+
+        handler = JOB_HANDLERS.get(kind)
+        try:
+            if handler is None:
+                raise LookupError(f"No handler registered for job kind '{kind}'.")
+            handler(JobContext(job_id, self.batch_size), **payload)
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception("Job %s (%s) failed on attempt %s", job_id, kind, attempts)
+            retry = handler is not None and attempts < self.max_attempts
+            db.session.execute(db.update(Job).where(Job.id == job_id).values(
+                status='queued' if retry else 'failed',
+                error=str(e),
+                finished_at=None if retry else datetime.utcnow()
+            ))
+            db.session.commit()
+            return False
+
+        db.session.execute(db.update(Job).where(Job.id == job_id).values(
+            status='done', error=None, finished_at=datetime.utcnow()))
+        db.session.commit()
+        return True
+
+    def run_pending(self):
+        ran = 0
+        while (job_id := self.claim()) is not None:
+            self.run(job_id)
+            ran += 1
+        return ran
+
+    def work(self, app, stop_when_idle=False):
+        while True:
+            with app.app_context():
+                try:
+                    ran = self.run_pending()
+                except Exception:
+                    app.logger.exception("Job worker failed to poll the queue")
+                    ran = 0
+                finally:
+                    db.session.remove()
+            if stop_when_idle and not ran:
+                return
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+
+job_queue = JobQueue()
+
+
+def notify_workers(session):
+    if session.info.pop('jobs_enqueued', False):
+        job_queue.notify()
+
+
+def discard_enqueued(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+@jobs_cli.command('work')
+@click.option('--once', is_flag=True, help="Exit when the queue is empty instead of polling.")
+def work_command(once):
+    """Run queued jobs in the foreground."""
+    job_queue.work(current_app._get_current_object(), stop_when_idle=once)
+
+
+def init_jobs(app):
+    job_queue.configure(
+        app,
+        workers=app.config['JOB_WORKERS'],
+        poll_interval=app.config['JOB_POLL_INTERVAL'],
+        stale_after=app.config['JOB_STALE_AFTER'],
+        max_attempts=app.config['JOB_MAX_ATTEMPTS'],
+        batch_size=app.config['JOB_BATCH_SIZE']
+    )
+    app.cli.add_command(jobs_cli)
+
+    if not event.contains(db.session, 'after_commit', notify_workers):
+        event.listen(db.session, 'after_commit', notify_workers)
+        event.listen(db.session, 'after_rollback', discard_enqueued)
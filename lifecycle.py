@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from cache import response_cache
+from extenstions import db
+from jobs import job
+from models import ArchivedListing, Listing
+
+lifecycle_cli = AppGroup('lifecycle', help="Listing retention and archiving.")
+
+ARCHIVED_COLUMNS = ('id', 'title', 'description', 'price', 'created_at', 'updated_at', 'status', 'user_id')
+
+
+def archive_cutoff(days=None):
+    if days is None:
+        days = current_app.config['LISTING_ARCHIVE_AFTER_DAYS']
+    return datetime.utcnow() - timedelta(days=days)
+
+
+def archive_sold_listings(cutoff, batch_size, on_batch=None):
+    """Move listings sold before `cutoff` to archived_listings, one commit per batch."""
+    archived = 0
+    while True:
+        ids = db.session.scalars(
+            db.select(Listing.id)
+            .where(Listing.status == 'sold', Listing.updated_at < cutoff)
+            .order_by(Listing.id)
+            .limit(batch_size)
+        ).all()
+        if not ids:
+            return archived
+
+        # copy and delete in the same transaction, a listing is always in
+        # exactly one of the two tables
+        now = datetime.utcnow()
+        db.session.execute(db.insert(ArchivedListing).from_select(
+            [*ARCHIVED_COLUMNS, 'archived_at'],
+            db.select(*(getattr(Listing, column) for column in ARCHIVED_COLUMNS), db.literal(now))
+            .where(Listing.id.in_(ids))
+        ))
+        db.session.execute(db.delete(Listing).where(Listing.id.in_(ids))
+                           .execution_options(synchronize_session=False))
+        if on_batch:
+            on_batch(len(ids))
+        db.session.commit()
+        response_cache.invalidate('listings', *(f"listing:{listing_id}" for listing_id in ids))
+        archived += len(ids)
+
+
+@job('archive_listings')
+def archive_listings_job(ctx, days=None):
+    cutoff = archive_cutoff(days)
+    ctx.set_total(db.session.scalar(db.select(db.func.count()).where(
+        Listing.status == 'sold', Listing.updated_at < cutoff)))
+    archive_sold_listings(cutoff, ctx.batch_size, on_batch=ctx.advance)
+
+
+@lifecycle_cli.command('archive')
+@click.option('--days', type=int, help="Archive listings sold more than this many days ago "
+                                        "(default: LISTING_ARCHIVE_AFTER_DAYS).")
+@click.option('--batch-size', default=500, show_default=True, help="Listings moved per commit.")
+@click.option('--queue', is_flag=True, help="Enqueue an archive job instead of running it here.")
+def archive_command(days, batch_size, queue):
+    """Move sold listings past the retention window to archived_listings."""
+    if queue:
+        queued = archive_listings_job.enqueue(days=days)
+        db.session.commit()
+        click.echo(f"Queued job {queued.id}.")
+        return
+
+    archived = archive_sold_listings(archive_cutoff(days), batch_size)
+    click.echo(f"Archived {archived} listings.")
@@ -0,0 +1,216 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g, jsonify, request
+
+from metrics import registry
+from replica import request_identity
+
+EXEMPT_ENDPOINTS = ('metrics', 'static')
+READ_METHODS = ('GET', 'HEAD')
+
+limiter_requests = registry.counter(
+    'limiter_requests_total', "Requests seen by admission control.", ('endpoint_class', 'result'))
+requests_in_flight = registry.gauge('limiter_requests_in_flight', "Requests currently admitted in this process.")
+in_flight_limit = registry.gauge('limiter_in_flight_limit', "Admitted requests above which this process sheds load.")
+
+
+def refill(tokens, updated_at, now, rate, burst):
+    """Take one token from a bucket last seen at `updated_at`.
+
+    Returns (tokens left, seconds until a token is available); the second
+    value is 0 when the token was granted.
+    """
+    tokens = min(burst, tokens + max(now - updated_at, 0) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+
+# Buckets of this worker process only, a client spread over N workers gets N budgets
+class MemoryBuckets:
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens, retry_after = refill(tokens, updated_at, now, rate, burst)
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_size:
+                # a bucket idle for a minute has refilled for any sane rate
+                self._buckets = {key: bucket for key, bucket in self._buckets.items() if bucket[1] > now - 60}
+        return retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# One SQLite file shared by every worker process on the host, so a client
+# gets one budget however requests are spread over the workers
+class SQLiteBuckets:
+    def __init__(self, path, max_size=100000):
+        self.path = path
+        self.max_size = max_size
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+                               "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def take(self, key, rate, burst):
+        connection = self._connection()
+        # IMMEDIATE takes the write lock up front, so two workers cannot both
+        # read the same token count and spend it twice
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            row = connection.execute("SELECT tokens, updated_at FROM rate_limit_buckets WHERE key = ?",
+                                     (key,)).fetchone()
+            tokens, updated_at = row or (burst, now)
+            tokens, retry_after = refill(tokens, updated_at, now, rate, burst)
+            connection.execute("INSERT OR REPLACE INTO rate_limit_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                               (key, tokens, now))
+            if row is None and connection.execute(
+                    "SELECT COUNT(*) FROM rate_limit_buckets").fetchone()[0] > self.max_size:
+                connection.execute("DELETE FROM rate_limit_buckets WHERE updated_at < ?", (now - 60,))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return retry_after
+
+    def clear(self):
+        self._connection().execute("DELETE FROM rate_limit_buckets")
+
+
+# Admission control, run before any other request work. Each request is
+# put in an endpoint class (auth, write or read) and charged one token from
+# the bucket of its JWT identity, or of its client address when anonymous;
+# an empty bucket gets a 429. Independently, a process with max_in_flight
+# requests already admitted answers 503 instead of queueing more requests
+# on a database pool that cannot serve them.
+class Limiter:
+    def __init__(self):
+        self.backend = None
+        self.limits = {}
+        self.max_in_flight = 0
+        self.shed_retry_after = 1
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def configure(self, backend, limits, max_in_flight, shed_retry_after):
+        self.backend = backend
+        self.limits = limits
+        self.max_in_flight = max_in_flight
+        self.shed_retry_after = shed_retry_after
+
+    def endpoint_class(self):
+        if request.blueprint == 'auth':
+            return 'auth'
+        return 'read' if request.method in READ_METHODS else 'write'
+
+    def client_key(self):
+        identity = request_identity()
+        return f"user:{identity}" if identity is not None else f"ip:{request.remote_addr}"
+
+    def check_rate(self, endpoint_class):
+        """Seconds the client must wait before this request is allowed, 0 to allow it."""
+        if self.backend is None or endpoint_class not in self.limits:
+            return 0
+        rate, burst = self.limits[endpoint_class]
+        return self.backend.take(f"{endpoint_class}:{self.client_key()}", rate, burst)
+
+    def acquire(self):
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def admit(self):
+        if request.method == 'OPTIONS' or request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+        endpoint_class = self.endpoint_class()
+
+        retry_after = self.check_rate(endpoint_class)
+        if retry_after:
+            limiter_requests.inc(endpoint_class=endpoint_class, result='limited')
+            return rejection("Too many requests. Please slow down.", 429, retry_after)
+
+        if not self.acquire():
+            limiter_requests.inc(endpoint_class=endpoint_class, result='shed')
+            current_app.logger.warning("Shedding %s %s, %d requests in flight",
+                                       request.method, request.path, self.in_flight)
+            return rejection("The server is busy. Please try again shortly.", 503, self.shed_retry_after)
+
+        g.limiter_admitted = True
+        limiter_requests.inc(endpoint_class=endpoint_class, result='admitted')
+        return None
+
+    def finish(self, exc=None):
+        if g.pop('limiter_admitted', False):
+            self.release()
+
+
+limiter = Limiter()
+
+
+def rejection(message, status, retry_after):
+    response = jsonify({"status": "error", "message": message})
+    response.headers['Retry-After'] = str(max(math.ceil(retry_after), 1))
+    return response, status
+
+
+@registry.collector
+def collect_limiter_stats():
+    requests_in_flight.set(limiter.in_flight)
+    in_flight_limit.set(limiter.max_in_flight)
+
+
+def default_max_in_flight(app):
+    # one request per connection the pool can hand out; anything past that
+    # would only wait in pool checkout until pool_timeout
+    profile = app.config['ENGINE_PROFILES'][app.config['ENGINE_PROFILE']]
+    return profile['pool_size'] + profile['max_overflow']
+
+
+def init_limiter(app):
+    backend = app.config['RATE_LIMIT_BACKEND']
+    if backend == 'memory':
+        buckets = MemoryBuckets()
+    elif backend == 'sqlite':
+        buckets = SQLiteBuckets(app.config['RATE_LIMIT_PATH'])
+    elif backend == 'none':
+        buckets = None
+    else:
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {backend}")
+
+    max_in_flight = app.config['LOAD_SHED_MAX_IN_FLIGHT']
+    limiter.configure(
+        buckets,
+        limits=app.config['RATE_LIMITS'],
+        max_in_flight=default_max_in_flight(app) if max_in_flight < 0 else max_in_flight,
+        shed_retry_after=app.config['LOAD_SHED_RETRY_AFTER']
+    )
+    app.before_request(limiter.admit)
+    app.teardown_request(limiter.finish)
@@ -0,0 +1,232 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from cache import response_cache
+from extenstions import db
+from hashing import password_hasher
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{format_labels(self.labels, key)} {value}"]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _render_value(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, '+Inf'), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, key, [('le', bound)])} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+        lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help_text, labels=()):
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def collector(self, func):
+        # called on every scrape, for values owned by other modules
+        self._collectors.append(func)
+        return func
+
+    def render(self):
+        for collect in self._collectors:
+            collect()
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_latency = registry.histogram(
+    'http_request_duration_seconds', "Request latency.", ('endpoint', 'method', 'status'))
+request_queries = registry.histogram(
+    'http_request_db_queries', "SQL statements issued per request.", ('endpoint',), QUERY_COUNT_BUCKETS)
+request_db_time = registry.histogram(
+    'http_request_db_duration_seconds', "Time spent in SQL statements per request.", ('endpoint',))
+startup_seconds = registry.gauge('app_startup_seconds', "Time create_app took in this process.")
+slow_queries = registry.counter(
+    'db_slow_queries_total', "SQL statements slower than SLOW_QUERY_THRESHOLD_MS.", ('endpoint',))
+
+cache_requests = registry.gauge('response_cache_requests', "Response cache lookups.", ('result',))
+cache_evictions = registry.gauge('response_cache_evictions', "Response cache entries evicted.")
+hasher_calls = registry.gauge('password_hash_calls', "Password hashing calls.", ('operation', 'result'))
+hasher_seconds = registry.gauge('password_hash_seconds', "Time spent hashing passwords.", ('operation', 'clock'))
+
+
+@registry.collector
+def collect_cache_stats():
+    stats = response_cache.stats()
+    cache_requests.set(stats['hits'], result='hit')
+    cache_requests.set(stats['misses'], result='miss')
+    cache_evictions.set(stats['evictions'])
+
+
+@registry.collector
+def collect_hasher_stats():
+    for operation, stats in password_hasher.stats().items():
+        hasher_calls.set(stats['count'], operation=operation, result='done')
+        hasher_calls.set(stats['rejected'], operation=operation, result='rejected')
+        hasher_seconds.set(stats['wall_seconds'], operation=operation, clock='wall')
+        hasher_seconds.set(stats['cpu_seconds'], operation=operation, clock='cpu')
+
+
+def current_endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started_at', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['query_started_at'].pop()
+    if not has_request_context() or 'query_count' not in g:
+        return
+
+    g.query_count += 1
+    g.query_time += elapsed
+
+    threshold = current_app.config['SLOW_QUERY_THRESHOLD_MS']
+    if threshold and elapsed * 1000 >= threshold:
+        slow_queries.inc(endpoint=current_endpoint())
+        current_app.logger.warning("Slow query in %s (%.1f ms): %s", current_endpoint(), elapsed * 1000, statement)
+
+
+def start_request_metrics():
+    g.request_started_at = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0.0
+
+
+def finish_request_metrics(response):
+    if 'request_started_at' not in g:
+        return response
+
+    endpoint = current_endpoint()
+    request_latency.observe(time.perf_counter() - g.request_started_at,
+                            endpoint=endpoint, method=request.method, status=response.status_code)
+    request_queries.observe(g.query_count, endpoint=endpoint)
+    request_db_time.observe(g.query_time, endpoint=endpoint)
+
+    if current_app.config['QUERY_COUNT_HEADER']:
+        response.headers['X-Query-Count'] = str(g.query_count)
+        response.headers['X-Query-Time-Ms'] = f"{g.query_time * 1000:.1f}"
+    return response
+
+
+def record_startup(app, seconds):
+    startup_seconds.set(seconds)
+    app.logger.info("App started in %.1f ms (pid %d)", seconds * 1000, os.getpid())
+
+
+def metrics_view():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def instrument_engine(engine):
+    if not event.contains(engine, 'before_cursor_execute', before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+def init_metrics(app):
+    with app.app_context():
+        for engine in db.engines.values():
+            instrument_engine(engine)
+
+    app.before_request(start_request_metrics)
+    app.after_request(finish_request_metrics)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
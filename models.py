@@ -1,4 +1,5 @@
 from datetime import datetime
+from decimal import Decimal
 
 from werkzeug.security import check_password_hash, generate_password_hash
 
@@ -12,6 +13,23 @@ user_roles = db.Table('user_roles',
 
 class Listing(db.Model):
     __tablename__ = 'listings'
+    # one index per filter/sort combination get_listings supports, every one
+    # ends in id so keyset pagination can seek straight to the next page.
+    # tests/test_query_plans.py (or `flask listings check-query-plans`)
+    # verifies none of the supported queries needs a table scan.
+    __table_args__ = (
+        db.Index('ix_listings_created_at_id', 'created_at', 'id'),
+        db.Index('ix_listings_price_id', 'price', 'id'),
+        db.Index('ix_listings_status_created_at', 'status', 'created_at', 'id'),
+        db.Index('ix_listings_status_price', 'status', 'price', 'id'),
+        db.Index('ix_listings_user_id_created_at', 'user_id', 'created_at', 'id'),
+        db.Index('ix_listings_user_id_price', 'user_id', 'price', 'id'),
+        # lifecycle.archive_sold_listings finds sold rows past retention
+        db.Index('ix_listings_status_updated_at', 'status', 'updated_at'),
+        # archived rows keep their ids and leave listings, SQLite must not
+        # hand the highest of them out again
+        {'sqlite_autoincrement': True},
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(50), nullable=False)
@@ -36,6 +54,38 @@ class Listing(db.Model):
             'status': self.status
         }
 
+# Sold listings past LISTING_ARCHIVE_AFTER_DAYS are moved here by
+# lifecycle.archive_sold_listings, keeping their ids, so `listings` only
+# holds the working set
+class ArchivedListing(db.Model):
+    __tablename__ = 'archived_listings'
+    __table_args__ = (
+        db.Index('ix_archived_listings_user_id', 'user_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String(50), nullable=False)
+    description = db.Column(db.Text, nullable=False)
+    price = db.Column(db.Numeric(10, 2), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'title': self.title,
+            'description': self.description,
+            'price': self.price,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+            'status': self.status,
+            'archived_at': self.archived_at
+        }
+
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -44,6 +94,8 @@ class User(db.Model):
     username = db.Column(db.String(32), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(128), nullable=False)
+    # snapshot of the wallet, entries in wallet_entries that are not folded yet
+    # still have to be added to it, see wallet.get_balance
     balance = db.Column(db.Numeric(10, 2), nullable=False)
     roles = db.relationship('Role', secondary=user_roles, backref=db.backref('users', lazy=True))
 
@@ -108,15 +160,26 @@ class Permission(db.Model):
 
 class Purchase(db.Model):
     __tablename__ = 'purchases'
+    __table_args__ = (
+        db.Index('ix_purchases_buyer_id_purchased_at', 'buyer_id', 'purchased_at'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    listing_id = db.Column(db.Integer, db.ForeignKey('listings.id'), nullable=False)
+    # no foreign key, the listing may live in listings or archived_listings
+    listing_id = db.Column(db.Integer, nullable=False)
     buyer_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    purchased_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow())
+    purchased_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
-    listing = db.relationship('Listing', backref='purchases')
+    listing = db.relationship('Listing', primaryjoin='foreign(Purchase.listing_id) == Listing.id',
+                              backref='purchases')
+    archived_listing = db.relationship('ArchivedListing', viewonly=True,
+                                       primaryjoin='foreign(Purchase.listing_id) == ArchivedListing.id')
     buyer = db.relationship('User', backref='purchases')
 
+    @property
+    def any_listing(self):
+        return self.listing or self.archived_listing
+
     def to_dict(self):
         return {
             'id': self.id,
@@ -124,3 +187,141 @@ class Purchase(db.Model):
             'buyer_id': self.buyer_id,
             'purchased_at': self.purchased_at
         }
+
+class WalletEntry(db.Model):
+    __tablename__ = 'wallet_entries'
+    __table_args__ = (
+        # only entries not yet folded into users.balance are ever scanned
+        db.Index('ix_wallet_entries_user_id_pending', 'user_id',
+                 sqlite_where=db.text('folded = 0'), postgresql_where=db.text('folded = false')),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    amount = db.Column(db.Numeric(10, 2), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)
+    folded = db.Column(db.Boolean, nullable=False, default=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'amount': self.amount,
+            'kind': self.kind,
+            'created_at': self.created_at
+        }
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # workers claim the oldest runnable job
+        db.Index('ix_jobs_status_id', 'status', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    error = db.Column(db.Text)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    # not a foreign key, jobs outlive the users they delete
+    created_by = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'total': self.total,
+            'error': self.error,
+            'attempts': self.attempts,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at
+        }
+
+# Dashboard counters kept up to date by stats.adjust_stats in the same
+# transaction as the write they describe; `flask stats reconcile` rebuilds them
+class UserStats(db.Model):
+    __tablename__ = 'user_stats'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True, autoincrement=False)
+    active_listings = db.Column(db.Integer, nullable=False, default=0)
+    sold_listings = db.Column(db.Integer, nullable=False, default=0)
+    sales_revenue = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    purchases = db.Column(db.Integer, nullable=False, default=0)
+    total_spent = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'user_id': self.user_id,
+            'active_listings': self.active_listings,
+            'sold_listings': self.sold_listings,
+            'sales_revenue': str(self.sales_revenue),
+            'purchases': self.purchases,
+            'total_spent': str(self.total_spent),
+            'updated_at': self.updated_at
+        }
+
+# Hourly and daily price aggregates, folded in by rollups.run_rollups
+class RollupBucket(db.Model):
+    __tablename__ = 'rollup_buckets'
+
+    metric = db.Column(db.String(20), primary_key=True)
+    granularity = db.Column(db.String(10), primary_key=True)
+    bucket_start = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    sum = db.Column(db.Numeric(14, 2), nullable=False)
+    min = db.Column(db.Numeric(10, 2), nullable=False)
+    max = db.Column(db.Numeric(10, 2), nullable=False)
+
+    def to_dict(self):
+        return {
+            'bucket_start': self.bucket_start,
+            'count': self.count,
+            'sum': str(self.sum),
+            'min': str(self.min),
+            'max': str(self.max),
+            'avg': str((self.sum / self.count).quantize(Decimal('0.01'))) if self.count else None
+        }
+
+class RollupWatermark(db.Model):
+    __tablename__ = 'rollup_watermarks'
+
+    metric = db.Column(db.String(20), primary_key=True)
+    # highest source row id already folded into rollup_buckets
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'metric': self.metric,
+            'last_id': self.last_id,
+            'updated_at': self.updated_at
+        }
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    __table_args__ = (
+        # the sweeper deletes expired keys in expires_at order
+        db.Index('ix_idempotency_keys_expires_at', 'expires_at'),
+    )
+
+    # sha256 of identity and Idempotency-Key, a fixed width primary key no
+    # matter how long the client's keys are
+    key_hash = db.Column(db.String(64), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    # null while the original request is still running
+    status_code = db.Column(db.Integer)
+    response_body = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,107 @@
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+
+from extenstions import db
+from metrics import registry
+
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping')
+
+checkout_wait = registry.histogram(
+    'db_pool_checkout_seconds', "Time spent waiting for a pooled connection.", buckets=CHECKOUT_BUCKETS)
+pool_exhausted = registry.counter(
+    'db_pool_exhausted_total', "Checkouts that timed out because the pool was exhausted.")
+pool_connections = registry.gauge(
+    'db_pool_connections', "Pooled connections by state.", ('bind', 'state'))
+
+
+class InstrumentedQueuePool(QueuePool):
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeout:
+            pool_exhausted.inc()
+            raise
+        finally:
+            checkout_wait.observe(time.perf_counter() - started_at)
+
+
+def is_memory_sqlite(uri):
+    url = make_url(uri)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+def get_profile(app):
+    name = app.config['ENGINE_PROFILE']
+    try:
+        return app.config['ENGINE_PROFILES'][name]
+    except KeyError:
+        raise ValueError(f"Unknown ENGINE_PROFILE '{name}', expected one of "
+                         f"{', '.join(app.config['ENGINE_PROFILES'])}.") from None
+
+
+def profile_engine_options(app):
+    profile = get_profile(app)
+    options = {'query_cache_size': profile['query_cache_size']}
+    # in-memory SQLite is pinned to a single StaticPool connection
+    if not is_memory_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+        options['poolclass'] = InstrumentedQueuePool
+        options.update((name, profile[name]) for name in POOL_OPTIONS)
+    return options
+
+
+def apply_sqlite_pragmas(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return on_connect
+
+
+def apply_postgresql_settings(settings):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in settings.items():
+            cursor.execute(f"SET {name} = '{value}'")
+        cursor.close()
+        # keep the SETs from being rolled back with the first transaction
+        dbapi_connection.commit()
+    return on_connect
+
+
+@registry.collector
+def collect_pool_stats():
+    for bind, engine in db.engines.items():
+        pool = engine.pool
+        if not isinstance(pool, QueuePool):
+            continue
+        bind = bind or 'default'
+        pool_connections.set(pool.checkedout(), bind=bind, state='checked_out')
+        pool_connections.set(pool.checkedin(), bind=bind, state='idle')
+        pool_connections.set(max(pool.overflow(), 0), bind=bind, state='overflow')
+        pool_connections.set(pool.size(), bind=bind, state='size')
+
+
+def configure_engines(app):
+    # must run before db.init_app, which reads SQLALCHEMY_ENGINE_OPTIONS;
+    # options set explicitly in the config win over the profile
+    options = profile_engine_options(app)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def init_pool(app):
+    profile = get_profile(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            dialect = engine.dialect.name
+            if dialect == 'sqlite' and profile['sqlite']:
+                event.listen(engine, 'connect', apply_sqlite_pragmas(profile['sqlite']))
+            elif dialect == 'postgresql' and profile['postgresql']:
+                event.listen(engine, 'connect', apply_postgresql_settings(profile['postgresql']))
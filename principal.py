@@ -0,0 +1,142 @@
+import threading
+import time
+from collections import OrderedDict
+
+from flask import jsonify
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+
+from extenstions import db, jwt
+from models import User, user_roles
+from replica import stick_to_primary, use_replica
+
+# Only identity columns are cached across requests. balance and password_hash
+# stay unloaded on cached principals and are read from the database on access.
+CACHED_COLUMNS = ('id', 'username', 'email')
+
+
+class PrincipalCache:
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, snapshot = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return snapshot
+
+    def set(self, user_id, snapshot):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+principal_cache = PrincipalCache()
+
+
+class PrincipalGone(Exception):
+    """The authenticated user no longer exists.
+
+    Cached principals are not re-read from the database, so a user deleted
+    by another worker is only noticed when their row turns out to be missing.
+    """
+    def __init__(self, user_id):
+        super().__init__(f"User {user_id} no longer exists.")
+        self.user_id = user_id
+
+
+def load_principal(jwt_header, jwt_data):
+    identity = jwt_data['sub']
+
+    # tokens issued before the switch to numeric ids carry the email address
+    if not identity.isdigit():
+        return User.query.filter_by(email=identity).first()
+
+    user_id = int(identity)
+    snapshot = principal_cache.get(user_id)
+    if snapshot is not None:
+        columns, role_ids = snapshot
+        user = User(**columns)
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+        user.role_ids = role_ids
+        return user
+
+    user = db.session.get(User, user_id)
+    if user is None and use_replica():
+        # just registered users may not have reached the replica yet
+        stick_to_primary()
+        user = db.session.get(User, user_id)
+    if user:
+        role_ids = tuple(db.session.execute(
+            db.select(user_roles.c.role_id).where(user_roles.c.user_id == user_id)
+        ).scalars())
+        principal_cache.set(user_id, ({column: getattr(user, column) for column in CACHED_COLUMNS}, role_ids))
+        user.role_ids = role_ids
+    return user
+
+
+def handle_principal_not_found(jwt_header, jwt_data):
+    return jsonify({
+        "status": "error",
+        "message": "User not found."
+    }), 401
+
+
+def handle_principal_gone(e):
+    principal_cache.invalidate(e.user_id)
+    return handle_principal_not_found(None, None)
+
+
+def collect_changed_users(session, flush_context, instances):
+    changed = session.info.setdefault('changed_user_ids', set())
+    for instance in session.dirty:
+        if isinstance(instance, User) and session.is_modified(instance):
+            changed.add(instance.id)
+    for instance in session.deleted:
+        if isinstance(instance, User):
+            changed.add(instance.id)
+
+
+def flush_changed_users(session):
+    for user_id in session.info.pop('changed_user_ids', ()):
+        principal_cache.invalidate(user_id)
+
+
+def discard_changed_users(session):
+    session.info.pop('changed_user_ids', None)
+
+
+def init_principal(app):
+    principal_cache.max_size = app.config['PRINCIPAL_CACHE_SIZE']
+    principal_cache.ttl = app.config['PRINCIPAL_CACHE_TTL']
+
+    jwt.user_lookup_loader(load_principal)
+    jwt.user_lookup_error_loader(handle_principal_not_found)
+    app.register_error_handler(PrincipalGone, handle_principal_gone)
+
+    if not event.contains(db.session, 'before_flush', collect_changed_users):
+        event.listen(db.session, 'before_flush', collect_changed_users)
+        event.listen(db.session, 'after_commit', flush_changed_users)
+        event.listen(db.session, 'after_rollback', discard_changed_users)
@@ -0,0 +1,100 @@
+import threading
+import time
+
+from sqlalchemy import event
+
+from extenstions import db
+from models import Permission, Role
+
+
+# In-memory map of role id -> frozenset of permission names, built from the
+# roles and permissions tables so authorization checks never hit the database
+class PermissionIndex:
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._by_role = None
+        self._roles = {}
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def rebuild(self):
+        rows = db.session.execute(
+            db.select(Role.id, Role.name, Permission.id, Permission.name)
+            .outerjoin(Permission, Permission.role_id == Role.id)
+            .order_by(Role.id, Permission.id)
+        ).all()
+
+        by_role = {}
+        roles = {}
+        for role_id, role_name, permission_id, permission_name in rows:
+            by_role.setdefault(role_id, set())
+            role = roles.setdefault(role_id, {'id': role_id, 'name': role_name, 'permissions': []})
+            if permission_id is not None:
+                by_role[role_id].add(permission_name)
+                role['permissions'].append({'id': permission_id, 'name': permission_name, 'role_id': role_id})
+
+        with self._lock:
+            self._by_role = {role_id: frozenset(names) for role_id, names in by_role.items()}
+            self._roles = roles
+            self._built_at = time.monotonic()
+        return self._by_role
+
+    def invalidate(self):
+        with self._lock:
+            self._by_role = None
+
+    def permissions(self):
+        by_role = self._by_role
+        if by_role is None or time.monotonic() - self._built_at > self.ttl:
+            by_role = self.rebuild()
+        return by_role
+
+    def allows(self, role_ids, permission_name):
+        by_role = self.permissions()
+        return any(permission_name in by_role.get(role_id, ()) for role_id in role_ids)
+
+    def roles(self, role_ids):
+        # same shape as Role.to_dict(), without loading roles and permissions
+        self.permissions()
+        roles = self._roles
+        return [roles[role_id] for role_id in role_ids if role_id in roles]
+
+
+permission_index = PermissionIndex()
+
+
+def get_role_ids(user):
+    # principals resolved by principal.load_principal carry their role ids
+    role_ids = getattr(user, 'role_ids', None)
+    if role_ids is None:
+        role_ids = [role.id for role in user.roles]
+    return role_ids
+
+
+def has_permission(user, permission_name):
+    return permission_index.allows(get_role_ids(user), permission_name)
+
+
+def collect_role_changes(session, flush_context, instances):
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(instance, (Role, Permission)):
+            session.info['roles_changed'] = True
+            return
+
+
+def flush_role_changes(session):
+    if session.info.pop('roles_changed', False):
+        permission_index.invalidate()
+
+
+def discard_role_changes(session):
+    session.info.pop('roles_changed', None)
+
+
+def init_rbac(app):
+    permission_index.ttl = app.config['PERMISSION_INDEX_TTL']
+
+    if not event.contains(db.session, 'before_flush', collect_role_changes):
+        event.listen(db.session, 'before_flush', collect_role_changes)
+        event.listen(db.session, 'after_commit', flush_role_changes)
+        event.listen(db.session, 'after_rollback', discard_role_changes)
@@ -0,0 +1,153 @@
+import os
+import sqlite3
+import threading
+import time
+
+import click
+from flask import current_app, g, has_request_context, request
+from flask.cli import AppGroup
+from flask_jwt_extended import decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from flask_sqlalchemy.session import Session
+from jwt import InvalidTokenError
+from sqlalchemy.sql import CompoundSelect, Select
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND = 'replica'
+READ_METHODS = ('GET', 'HEAD')
+STICKY_COOKIE = 'easybuy_primary'
+
+replica_cli = AppGroup('replica', help="Read replica maintenance.")
+
+
+class StickyWindow:
+    """Identities that wrote recently and must keep reading from the primary."""
+
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self._expires = {}
+        self._lock = threading.Lock()
+
+    def mark(self, identity):
+        now = time.monotonic()
+        with self._lock:
+            self._expires[identity] = now + self.ttl
+            if len(self._expires) > 10000:
+                self._expires = {key: expires for key, expires in self._expires.items() if expires > now}
+
+    def is_sticky(self, identity):
+        with self._lock:
+            expires_at = self._expires.get(identity)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._expires.clear()
+
+
+sticky_window = StickyWindow()
+
+
+def request_identity():
+    # the JWT is decoded here, ahead of jwt_required, because routing is
+    # decided on the first statement, which may be the principal lookup
+    if 'replica_identity' not in g:
+        identity = None
+        scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+        if scheme == 'Bearer' and token:
+            try:
+                identity = decode_token(token)['sub']
+            except (JWTExtendedException, InvalidTokenError):
+                identity = None
+        g.replica_identity = identity
+    return g.replica_identity
+
+
+def use_replica():
+    if not has_request_context() or request.method not in READ_METHODS:
+        return False
+    if g.get('force_primary') or g.get('wrote_to_primary'):
+        return False
+    if request.cookies.get(STICKY_COOKIE):
+        return False
+    identity = request_identity()
+    return identity is None or not sticky_window.is_sticky(identity)
+
+
+def has_replica():
+    return REPLICA_BIND in current_app.extensions['sqlalchemy'].engines
+
+
+def reads_from_replica():
+    """Whether plain SELECTs of the current request go to the replica."""
+    return has_replica() and use_replica()
+
+
+def stick_to_primary():
+    """Read from the primary for the rest of the request."""
+    g.force_primary = True
+
+
+def is_read(clause):
+    if isinstance(clause, CompoundSelect):
+        return True
+    return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+class RoutingSession(Session):
+    """Sends plain SELECTs from read-only requests to the replica bind."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                g.wrote_to_primary = True
+            else:
+                replica = self._db.engines.get(REPLICA_BIND)
+                if replica is not None and is_read(clause) and use_replica():
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def mark_sticky(response):
+    if g.get('wrote_to_primary'):
+        identity = request_identity()
+        if identity is not None:
+            sticky_window.mark(identity)
+        # the cookie carries the window to other workers for clients that keep cookies
+        response.set_cookie(STICKY_COOKIE, '1', max_age=max(int(sticky_window.ttl), 1), httponly=True)
+    return response
+
+
+def sqlite_path(engine):
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return None
+    return engine.url.database
+
+
+@replica_cli.command('sync')
+def sync_command():
+    """Copy the SQLite primary onto the SQLite replica."""
+    db = current_app.extensions['sqlalchemy']
+    replica = db.engines.get(REPLICA_BIND)
+    if replica is None:
+        raise click.ClickException("No replica bind configured, set REPLICA_DATABASE_URI.")
+
+    source, target = sqlite_path(db.engines[None]), sqlite_path(replica)
+    if source is None or target is None:
+        raise click.ClickException("sync only copies file-based SQLite databases; "
+                                   "use the database's own replication otherwise.")
+
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    src, dst = sqlite3.connect(source), sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+    click.echo(f"Copied {source} to {target}.")
+
+
+def init_replica(app):
+    sticky_window.ttl = app.config['REPLICA_STICKY_SECONDS']
+    app.after_request(mark_sticky)
+    app.cli.add_command(replica_cli)
@@ -0,0 +1,141 @@
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from extenstions import db
+from jobs import job
+from models import ArchivedListing, Listing, Purchase, RollupBucket, RollupWatermark
+from utils import dialect_insert
+
+rollups_cli = AppGroup('rollups', help="Marketplace analytics rollups.")
+
+GRANULARITIES = {
+    'hour': lambda moment: moment.replace(minute=0, second=0, microsecond=0),
+    'day': lambda moment: moment.replace(hour=0, minute=0, second=0, microsecond=0),
+}
+
+
+# Each metric is a stream of (id, timestamp, price) rows read past the
+# watermark. Listing status changes after insert, so rollups count events
+# (a listing was listed, a listing was sold) rather than current status.
+def sales_rows():
+    return (db.select(Purchase.id, Purchase.purchased_at, db.func.coalesce(Listing.price, ArchivedListing.price))
+            .outerjoin(Purchase.listing)
+            .outerjoin(Purchase.archived_listing)), Purchase.id, Purchase.purchased_at
+
+
+def listings_rows():
+    return db.select(Listing.id, Listing.created_at, Listing.price), Listing.id, Listing.created_at
+
+
+METRICS = {
+    'sales': sales_rows,
+    'listings': listings_rows,
+}
+
+
+def aggregate(rows):
+    buckets = defaultdict(lambda: [0, 0, None, None])
+    for _, moment, price in rows:
+        # purchases whose listing was deleted have no price left to fold
+        if price is None:
+            continue
+        for granularity, floor in GRANULARITIES.items():
+            bucket = buckets[(granularity, floor(moment))]
+            bucket[0] += 1
+            bucket[1] += price
+            bucket[2] = price if bucket[2] is None else min(bucket[2], price)
+            bucket[3] = price if bucket[3] is None else max(bucket[3], price)
+    return buckets
+
+
+def fold_buckets(metric, buckets):
+    if not buckets:
+        return
+    statement = dialect_insert(RollupBucket).values([
+        {'metric': metric, 'granularity': granularity, 'bucket_start': bucket_start,
+         'count': count, 'sum': total, 'min': lowest, 'max': highest}
+        for (granularity, bucket_start), (count, total, lowest, highest) in buckets.items()
+    ])
+    # scalar min()/max() on SQLite, least()/greatest() on Postgres
+    if db.session.get_bind(mapper=RollupBucket).dialect.name == 'postgresql':
+        least, greatest = db.func.least, db.func.greatest
+    else:
+        least, greatest = db.func.min, db.func.max
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[RollupBucket.metric, RollupBucket.granularity, RollupBucket.bucket_start],
+        set_={
+            'count': RollupBucket.count + statement.excluded.count,
+            'sum': RollupBucket.sum + statement.excluded.sum,
+            'min': least(RollupBucket.min, statement.excluded.min),
+            'max': greatest(RollupBucket.max, statement.excluded.max),
+        }
+    ))
+
+
+def run_rollup(metric, batch_size, settle_seconds):
+    """Fold rows past the watermark of `metric` into rollup_buckets, return how many were read.
+
+    Only rows older than settle_seconds are read, so a row whose transaction
+    commits after a higher id was already folded is not skipped.
+    """
+    statement, id_column, time_column = METRICS[metric]()
+    cutoff = datetime.utcnow() - timedelta(seconds=settle_seconds)
+
+    db.session.execute(dialect_insert(RollupWatermark).values(metric=metric, last_id=0)
+                       .on_conflict_do_nothing(index_elements=[RollupWatermark.metric]))
+    db.session.commit()
+
+    folded = 0
+    while True:
+        last_id = db.session.scalar(db.select(RollupWatermark.last_id).where(RollupWatermark.metric == metric))
+        rows = db.session.execute(
+            statement.where(id_column > last_id, time_column <= cutoff).order_by(id_column).limit(batch_size)
+        ).all()
+        if not rows:
+            db.session.commit()
+            return folded
+
+        fold_buckets(metric, aggregate(rows))
+        # buckets and watermark move together; a concurrent run that read the
+        # same watermark loses here and rolls its buckets back
+        moved = db.session.execute(
+            db.update(RollupWatermark)
+            .where(RollupWatermark.metric == metric, RollupWatermark.last_id == last_id)
+            .values(last_id=rows[-1][0], updated_at=datetime.utcnow())
+        ).rowcount
+        if not moved:
+            db.session.rollback()
+            raise RuntimeError(f"Rollup '{metric}' is already being run elsewhere.")
+        db.session.commit()
+        folded += len(rows)
+
+
+def run_rollups(batch_size=None):
+    batch_size = batch_size or current_app.config['ROLLUP_BATCH_SIZE']
+    settle_seconds = current_app.config['ROLLUP_SETTLE_SECONDS']
+    return {metric: run_rollup(metric, batch_size, settle_seconds) for metric in METRICS}
+
+
+@job('run_rollups')
+def run_rollups_job(ctx):
+    folded = run_rollups()
+    ctx.advance(sum(folded.values()))
+
+
+@rollups_cli.command('run')
+@click.option('--batch-size', type=int, help="Source rows folded per commit (default: ROLLUP_BATCH_SIZE).")
+@click.option('--queue', is_flag=True, help="Enqueue a rollup job instead of running it here.")
+def run_command(batch_size, queue):
+    """Fold new purchases and listings into the hourly and daily rollups."""
+    if queue:
+        queued = run_rollups_job.enqueue()
+        db.session.commit()
+        click.echo(f"Queued job {queued.id}.")
+        return
+
+    for metric, folded in run_rollups(batch_size).items():
+        click.echo(f"{metric}: folded {folded} rows.")
@@ -0,0 +1,103 @@
+import click
+from flask.cli import AppGroup
+from sqlalchemy import DDL, event
+
+from extenstions import db
+from models import Listing
+
+search_cli = AppGroup('search', help="Full-text search index maintenance.")
+
+# SQLite: an external-content FTS5 table over listings.title/description,
+# kept in sync by triggers so every write path (ORM, bulk inserts, deletes)
+# updates it in the same transaction
+SQLITE_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5("
+    "title, description, content='listings', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings BEGIN "
+    "INSERT INTO listings_fts (rowid, title, description) VALUES (new.id, new.title, new.description); END",
+    "CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings BEGIN "
+    "INSERT INTO listings_fts (listings_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); END",
+    "CREATE TRIGGER IF NOT EXISTS listings_fts_update AFTER UPDATE OF title, description ON listings BEGIN "
+    "INSERT INTO listings_fts (listings_fts, rowid, title, description) "
+    "VALUES ('delete', old.id, old.title, old.description); "
+    "INSERT INTO listings_fts (rowid, title, description) VALUES (new.id, new.title, new.description); END"
+]
+
+# PostgreSQL: a generated tsvector column, maintained by the database on
+# every insert/update, with a GIN index over it
+POSTGRESQL_DDL = [
+    "ALTER TABLE listings ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ("
+    "setweight(to_tsvector('english', title), 'A') || setweight(to_tsvector('english', description), 'B')) STORED",
+    "CREATE INDEX IF NOT EXISTS ix_listings_search_vector ON listings USING GIN (search_vector)"
+]
+
+for statement in SQLITE_DDL:
+    event.listen(Listing.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in POSTGRESQL_DDL:
+    event.listen(Listing.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+
+class SearchUnavailable(Exception):
+    pass
+
+
+def fts5_query(text):
+    # every term is quoted so user input cannot use FTS5 query syntax,
+    # terms are ANDed together
+    terms = text.split()
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def search_statement(columns, text, status):
+    dialect = db.session.get_bind().dialect.name
+
+    if dialect == 'sqlite':
+        fts = db.literal_column('listings_fts')
+        statement = (db.select(*columns)
+                     .select_from(db.table('listings_fts'))
+                     .join(Listing, Listing.id == db.literal_column('listings_fts.rowid'))
+                     .where(fts.op('MATCH')(fts5_query(text)))
+                     .order_by(db.func.bm25(fts, 10.0, 1.0), Listing.id))
+    elif dialect == 'postgresql':
+        search_vector = db.literal_column('listings.search_vector')
+        query = db.func.websearch_to_tsquery('english', text)
+        statement = (db.select(*columns)
+                     .where(search_vector.op('@@')(query))
+                     .order_by(db.func.ts_rank(search_vector, query).desc(), Listing.id))
+    else:
+        raise SearchUnavailable(f"Search is not available on {dialect}.")
+
+    if status:
+        statement = statement.where(Listing.status == status)
+    return statement
+
+
+def ddl_for_dialect():
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return SQLITE_DDL
+    if dialect == 'postgresql':
+        return POSTGRESQL_DDL
+    raise click.ClickException(f"Search is not available on {dialect}.")
+
+
+@search_cli.command('init')
+def init_command():
+    """Create the search index on an existing listings table."""
+    for statement in ddl_for_dialect():
+        db.session.execute(db.text(statement))
+    if db.engine.dialect.name == 'sqlite':
+        db.session.execute(db.text("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    click.echo("Search index is ready.")
+
+
+@search_cli.command('rebuild')
+def rebuild_command():
+    """Rebuild the SQLite FTS5 index from the listings table."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException("Only the SQLite index needs rebuilding, PostgreSQL maintains it itself.")
+    db.session.execute(db.text("INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')"))
+    db.session.commit()
+    click.echo("Search index rebuilt.")
@@ -0,0 +1,67 @@
+import json
+from functools import lru_cache
+
+from flask import current_app, request
+from werkzeug.http import http_date
+
+from models import Listing
+from rbac import get_role_ids, permission_index
+
+# Field name -> (column, encoder). Encoders produce the same values jsonify
+# would for these types, None marks values that are JSON-native already.
+LISTING_FIELDS = {
+    'id': (Listing.id, None),
+    'user_id': (Listing.user_id, None),
+    'title': (Listing.title, None),
+    'description': (Listing.description, None),
+    'price': (Listing.price, str),
+    'created_at': (Listing.created_at, http_date),
+    'updated_at': (Listing.updated_at, http_date),
+    'status': (Listing.status, None)
+}
+
+
+def get_fields_arg(available):
+    value = request.args.get('fields')
+    if not value:
+        return tuple(available)
+
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in available]
+    if unknown or not fields:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}. Available fields: {', '.join(available)}")
+    return fields
+
+
+@lru_cache(maxsize=128)
+def listing_projection(fields, extra_columns=()):
+    # Returns the columns to select and an encoder turning one result row into
+    # a dict. extra_columns are appended after the requested fields so callers
+    # can read them (e.g. for cursors) without them showing up in the output.
+    columns = [LISTING_FIELDS[field][0] for field in fields] + list(extra_columns)
+    plain = tuple((field, index) for index, field in enumerate(fields) if LISTING_FIELDS[field][1] is None)
+    converted = tuple((field, index, LISTING_FIELDS[field][1])
+                      for index, field in enumerate(fields) if LISTING_FIELDS[field][1] is not None)
+
+    def encode(row):
+        item = {field: row[index] for field, index in plain}
+        for field, index, encoder in converted:
+            item[field] = encoder(row[index])
+        return item
+
+    return columns, encode
+
+
+def serialize_user(user, balance):
+    return {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'balance': str(balance),
+        'roles': permission_index.roles(get_role_ids(user))
+    }
+
+
+def json_response(payload, status=200):
+    body = json.dumps(payload, separators=(',', ':'))
+    return current_app.response_class(body + '\n', status=status, mimetype='application/json')
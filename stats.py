@@ -0,0 +1,166 @@
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from extenstions import db
+from jobs import job
+from models import ArchivedListing, Listing, Purchase, User, UserStats
+from utils import dialect_insert
+
+stats_cli = AppGroup('stats', help="Per-user dashboard aggregates.")
+
+STAT_COLUMNS = ('active_listings', 'sold_listings', 'sales_revenue', 'purchases', 'total_spent')
+
+
+def upsert_stats(rows, increment):
+    statement = dialect_insert(UserStats).values(rows)
+    values = {column: getattr(statement.excluded, column) for column in STAT_COLUMNS}
+    if increment:
+        values = {column: getattr(UserStats, column) + value for column, value in values.items()}
+    statement = statement.on_conflict_do_update(
+        index_elements=[UserStats.user_id],
+        set_={**values, 'updated_at': statement.excluded.updated_at}
+    )
+    db.session.execute(statement)
+
+
+def adjust_stats(deltas):
+    """Add {user_id: {column: delta}} to user_stats in one statement.
+
+    Runs in the caller's transaction, so the counters commit or roll back
+    together with the write they describe.
+    """
+    if not deltas:
+        return
+    now = datetime.utcnow()
+    upsert_stats([
+        {'user_id': user_id, **{column: changes.get(column, 0) for column in STAT_COLUMNS}, 'updated_at': now}
+        for user_id, changes in deltas.items()
+    ], increment=True)
+
+
+def sale_deltas(sales):
+    """Stat deltas for (seller_id, buyer_id, price) sales."""
+    deltas = defaultdict(lambda: defaultdict(int))
+    for seller_id, buyer_id, price in sales:
+        deltas[seller_id]['active_listings'] -= 1
+        deltas[seller_id]['sold_listings'] += 1
+        deltas[seller_id]['sales_revenue'] += price
+        deltas[buyer_id]['purchases'] += 1
+        deltas[buyer_id]['total_spent'] += price
+    return deltas
+
+
+def get_stats(user_id):
+    stats = db.session.get(UserStats, user_id)
+    if stats is None:
+        return UserStats(user_id=user_id, active_listings=0, sold_listings=0, sales_revenue=Decimal('0.00'),
+                         purchases=0, total_spent=Decimal('0.00'), updated_at=None)
+    return stats
+
+
+def compute_stats(user_ids):
+    """Recompute the counters of `user_ids` from listings, archive and purchases."""
+    stats = {user_id: dict.fromkeys(STAT_COLUMNS, 0) for user_id in user_ids}
+
+    active = db.session.execute(
+        db.select(Listing.user_id, db.func.count())
+        .where(Listing.user_id.in_(user_ids), Listing.status == 'active')
+        .group_by(Listing.user_id)
+    )
+    for user_id, count in active:
+        stats[user_id]['active_listings'] = count
+
+    sold = db.union_all(
+        db.select(Listing.user_id, Listing.price).where(Listing.user_id.in_(user_ids), Listing.status == 'sold'),
+        db.select(ArchivedListing.user_id, ArchivedListing.price)
+        .where(ArchivedListing.user_id.in_(user_ids), ArchivedListing.status == 'sold')
+    ).subquery()
+    for user_id, count, revenue in db.session.execute(
+            db.select(sold.c.user_id, db.func.count(), db.func.sum(sold.c.price)).group_by(sold.c.user_id)):
+        stats[user_id]['sold_listings'] = count
+        stats[user_id]['sales_revenue'] = revenue
+
+    price = db.func.coalesce(Listing.price, ArchivedListing.price)
+    bought = db.session.execute(
+        db.select(Purchase.buyer_id, db.func.count(), db.func.sum(price))
+        .outerjoin(Purchase.listing)
+        .outerjoin(Purchase.archived_listing)
+        .where(Purchase.buyer_id.in_(user_ids))
+        .group_by(Purchase.buyer_id)
+    )
+    for user_id, count, spent in bought:
+        stats[user_id]['purchases'] = count
+        stats[user_id]['total_spent'] = spent or 0
+
+    return stats
+
+
+def reconcile(user_ids):
+    """Overwrite the counters of `user_ids` with recomputed values, return how many had drifted."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    expected = compute_stats(user_ids)
+    current = {stats.user_id: stats for stats in db.session.scalars(
+        db.select(UserStats).where(UserStats.user_id.in_(user_ids)))}
+
+    # a missing row reads as all zeros, see get_stats
+    def stored(user_id, column):
+        return Decimal(str(getattr(current[user_id], column))) if user_id in current else 0
+
+    drifted = [
+        user_id for user_id, values in expected.items()
+        if any(stored(user_id, column) != Decimal(str(value)) for column, value in values.items())
+    ]
+    if drifted:
+        now = datetime.utcnow()
+        upsert_stats([{'user_id': user_id, **expected[user_id], 'updated_at': now} for user_id in drifted],
+                     increment=False)
+    return len(drifted)
+
+
+def reconcile_all(batch_size, on_batch=None):
+    drifted = 0
+    last_id = 0
+    while True:
+        user_ids = db.session.scalars(
+            db.select(User.id).where(User.id > last_id).order_by(User.id).limit(batch_size)
+        ).all()
+        if not user_ids:
+            return drifted
+        drifted += reconcile(user_ids)
+        if on_batch:
+            on_batch(len(user_ids))
+        db.session.commit()
+        last_id = user_ids[-1]
+
+
+@job('reconcile_user_stats')
+def reconcile_user_stats_job(ctx, user_ids=None):
+    if user_ids is not None:
+        drifted = reconcile(user_ids)
+        ctx.advance(len(user_ids))
+    else:
+        ctx.set_total(db.session.scalar(db.select(db.func.count(User.id))))
+        drifted = reconcile_all(ctx.batch_size, on_batch=ctx.advance)
+    current_app.logger.info("Reconciled user stats, %s users had drifted", drifted)
+
+
+@stats_cli.command('reconcile')
+@click.option('--batch-size', default=500, show_default=True, help="Users recomputed per commit.")
+@click.option('--queue', is_flag=True, help="Enqueue a reconcile job instead of running it here.")
+def reconcile_command(batch_size, queue):
+    """Recompute user_stats from the listing and purchase tables."""
+    if queue:
+        queued = reconcile_user_stats_job.enqueue()
+        db.session.commit()
+        click.echo(f"Queued job {queued.id}.")
+        return
+
+    drifted = reconcile_all(batch_size)
+    click.echo(f"Reconciled user stats, {drifted} users had drifted.")
@@ -1,11 +1,19 @@
+import base64
+import json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
 from functools import wraps
+from math import ceil
 
-from flask import jsonify
-from flask_jwt_extended import get_jwt_identity
+from flask import current_app, jsonify, request
+from flask_jwt_extended import get_current_user
 from flask_jwt_extended.exceptions import NoAuthorizationError
 from jwt import ExpiredSignatureError, InvalidTokenError
+from sqlalchemy.dialects import postgresql, sqlite
 
-from models import User
+from extenstions import db
+from hashing import HasherBusy
+from rbac import has_permission
 
 
 def validate_request(data, required_fields):
@@ -14,13 +22,93 @@ def validate_request(data, required_fields):
         return f"Missing fields: {', '.join(missing_fields)}"
     return None
 
+def parse_price(value):
+    try:
+        price = Decimal(value)
+        if not price.is_finite() or price <= 0:
+            raise ValueError
+    except (ValueError, TypeError, InvalidOperation) as e:
+        raise ValueError("Price must be a positive number.") from e
+    return price
+
+# largest value a Numeric(10, 2) wallet column holds
+MAX_AMOUNT = Decimal('99999999.99')
+
+def parse_amount(value):
+    # rejected here, before credit/debit, because a non-finite or oversized
+    # entry would make every later balance read fail
+    try:
+        amount = Decimal(value)
+        if not amount.is_finite():
+            raise ValueError
+    except (ValueError, TypeError, InvalidOperation) as e:
+        raise ValueError("Invalid amount provided.") from e
+    if amount <= 0:
+        raise ValueError("Amount must be greater than zero.")
+    if amount > MAX_AMOUNT or amount != amount.quantize(Decimal('0.01')):
+        raise ValueError(f"Amount must have at most two decimal places and not exceed {MAX_AMOUNT}.")
+    return amount
+
+def get_page_args():
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', current_app.config['DEFAULT_PER_PAGE'], type=int)
+    return max(page, 1), min(max(per_page, 1), current_app.config['MAX_PER_PAGE'])
+
+def paginate_rows(statement, page, per_page):
+    # like Query.paginate, but for column selects that should not be turned into ORM objects
+    total = db.session.execute(
+        db.select(db.func.count()).select_from(statement.order_by(None).subquery())
+    ).scalar()
+    rows = db.session.execute(statement.limit(per_page).offset((page - 1) * per_page)).all()
+    return {
+        "page": page,
+        "per_page": per_page,
+        "total_items": total,
+        "total_pages": ceil(total / per_page)
+    }, rows
+
+def encode_cursor(*values):
+    values = [value.isoformat() if isinstance(value, datetime) else
+              str(value) if isinstance(value, Decimal) else value
+              for value in values]
+    raw = json.dumps(values).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    # raises ValueError on anything that was not produced by encode_cursor
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(raw)
+    except (TypeError, ValueError, UnicodeDecodeError) as e:
+        raise ValueError("Invalid cursor.") from e
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor.")
+    return values
+
+def get_datetime_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError as e:
+        raise ValueError(f"{name} must be an ISO 8601 date or datetime.") from e
+
+def dialect_insert(model):
+    """insert() of the dialect `model` is stored in, for ON CONFLICT upserts."""
+    dialect = db.session.get_bind(mapper=model).dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(model)
+    if dialect == 'sqlite':
+        return sqlite.insert(model)
+    raise NotImplementedError(f"Upserts are not implemented for {dialect}.")
+
 def permission_required(permission_name):
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            email = get_jwt_identity()
-            user = User.query.filter_by(email=email).first()
-            if not user or not user.has_permission(permission_name):
+            user = get_current_user()
+            if not user or not has_permission(user, permission_name):
                 return jsonify({
                     "status": "error",
                     "message": "You do not have permission to perform this action."
@@ -44,6 +132,15 @@ def register_error_handlers(app):
             "message": "Your token has expired. Please log in again."
         }), 401
 
+    @app.errorhandler(HasherBusy)
+    def handle_hasher_busy(e):
+        response = jsonify({
+            "status": "error",
+            "message": "The server is busy. Please try again shortly."
+        })
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+
     @app.errorhandler(InvalidTokenError)
     def handle_invalid_token_error(e):
         return jsonify({
@@ -0,0 +1,97 @@
+from decimal import Decimal
+
+import click
+from flask.cli import AppGroup
+
+from extenstions import db
+from jobs import job
+from models import User, WalletEntry
+
+wallet_cli = AppGroup('wallet', help="Wallet ledger maintenance.")
+
+
+def get_balance(user_id):
+    pending = (db.select(db.func.coalesce(db.func.sum(WalletEntry.amount), 0))
+               .where(WalletEntry.user_id == User.id, WalletEntry.folded == False)
+               .scalar_subquery())
+    balance = db.session.execute(db.select(User.balance, pending).where(User.id == user_id)).first()
+    if balance is None:
+        return None
+    return (balance[0] + Decimal(balance[1])).quantize(Decimal('0.01'))
+
+
+def credit(user_id, amount, kind):
+    # a plain insert, concurrent credits to one account never touch the same row
+    db.session.add(WalletEntry(user_id=user_id, amount=amount, kind=kind))
+
+
+def fold(user_id):
+    # marks every pending entry as folded and returns their sum, entries
+    # committed concurrently are either returned here or stay pending
+    amounts = db.session.execute(
+        db.update(WalletEntry)
+        .where(WalletEntry.user_id == user_id, WalletEntry.folded == False)
+        .values(folded=True)
+        .returning(WalletEntry.amount)
+    ).scalars().all()
+    return sum(amounts, Decimal('0'))
+
+
+def debit(user_id, amount, kind):
+    # the conditional update enforces the balance floor, callers roll back
+    # when this returns False so the fold above is undone as well
+    pending = fold(user_id)
+    debited = db.session.execute(
+        db.update(User)
+        .where(User.id == user_id, User.balance + pending >= amount)
+        .values(balance=User.balance + pending - amount)
+    ).rowcount
+    if not debited:
+        return False
+
+    db.session.add(WalletEntry(user_id=user_id, amount=-amount, kind=kind, folded=True))
+    return True
+
+
+def compact(user_id):
+    pending = fold(user_id)
+    if pending:
+        db.session.execute(db.update(User).where(User.id == user_id).values(balance=User.balance + pending))
+
+
+def compact_all(batch_size, on_batch=None):
+    """Fold every account with pending entries, batch_size accounts per commit."""
+    folded = 0
+    while True:
+        user_ids = db.session.execute(
+            db.select(WalletEntry.user_id).where(WalletEntry.folded == False).distinct().limit(batch_size)
+        ).scalars().all()
+        if not user_ids:
+            return folded
+        for user_id in user_ids:
+            compact(user_id)
+        if on_batch:
+            on_batch(len(user_ids))
+        db.session.commit()
+        folded += len(user_ids)
+
+
+@job('compact_wallets')
+def compact_wallets_job(ctx):
+    ctx.set_total(db.session.scalar(
+        db.select(db.func.count(db.distinct(WalletEntry.user_id))).where(WalletEntry.folded == False)))
+    compact_all(ctx.batch_size, on_batch=ctx.advance)
+
+
+@wallet_cli.command('compact')
+@click.option('--batch-size', default=500, show_default=True, help="Accounts folded per commit.")
+@click.option('--queue', is_flag=True, help="Enqueue a compaction job instead of running it here.")
+def compact_command(batch_size, queue):
+    """Fold pending wallet entries into users.balance."""
+    if queue:
+        queued = compact_wallets_job.enqueue()
+        db.session.commit()
+        click.echo(f"Queued job {queued.id}.")
+        return
+
+    click.echo(f"Compacted {compact_all(batch_size)} wallets.")